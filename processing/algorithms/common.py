@@ -11,6 +11,8 @@ import scipy
 import wradlib as wrl
 from scipy.interpolate import interp1d
 
+from processing.utils.srtm.terrain import get_terrain
+
 
 def antenna_to_cartesian(ranges, azimuths, elevations):
     """
@@ -203,6 +205,9 @@ def beam_blocking(radar, srtm_ffn):
     # init output cumulative beam blocking
     radar_ccb = np.zeros((radar.nrays, radar.ngates))
 
+    # clipped DEM covering the station's maximum range, read once per station
+    terrain = get_terrain(srtm_ffn, sitecoords, nbins * range_res, np.min(el_list))
+
     for tilt, el in enumerate(el_list):
         # indexcurrent slice
         sweep_idx = radar.get_slice(tilt)
@@ -220,15 +225,8 @@ def beam_blocking(radar, srtm_ffn):
         polcoords = coords[..., :2]
         rlimits = (lon.min(), lat.min(), lon.max(), lat.max())
 
-        # read geotiff
-        ds = wrl.io.open_raster(srtm_ffn)
-        rastervalues, rastercoords, _ = wrl.georef.extract_raster_dataset(
-            ds, nodata=-32768.)
-
         # Clip the region inside our bounding box
-        ind = wrl.util.find_bbox_indices(rastercoords, rlimits)
-        rastercoords = rastercoords[ind[1]:ind[3], ind[0]:ind[2], ...]
-        rastervalues = rastervalues[ind[1]:ind[3], ind[0]:ind[2]]
+        rastercoords, rastervalues = terrain.window(rlimits)
 
         # Map rastervalues to polar grid points
         polarvalues = wrl.ipol.cart_to_irregular_spline(
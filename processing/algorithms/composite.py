@@ -0,0 +1,145 @@
+"""
+Vertical composites of polar fields on the lowest sweep.
+
+Products calculated over every sweep of a volume are reduced to the
+(ray, gate) columns of sweep 0 so they can be contoured the same way as
+the single sweep products. Which samples of each sweep lie above a column
+only depends on the station's geometry and is shared through
+processing.utils.geometry.
+
+Time compositing against reducing a volume to sweep 0 alone with:
+
+    python3 -m processing.algorithms.composite [SWEEPS]
+"""
+import sys
+import time
+
+import numpy as np
+
+from processing.utils import geometry
+
+# HSDA small, large and giant hail, and HCA rain/hail left where HSDA could
+# not size it. 9 is the smallest, so any sized hail above a column wins.
+HAIL_CLASSES = (9, 11, 12, 13)
+
+
+def column_max(radar, field):
+    """
+    Maximum of a field over every sweep above each column of sweep 0.
+
+    Returns
+    -------
+    composite : MaskedArray
+        (rays of sweep 0, ngates) float32, masked where no sweep has data.
+
+    """
+    data = radar.fields[field]['data']
+    ref_slice = radar.get_slice(0)
+    composite = np.full((ref_slice.stop - ref_slice.start, radar.ngates), -np.inf, dtype=np.float32)
+    for sweep, (rays, in_range, gates) in enumerate(geometry.sweep_columns(radar)):
+        samples = np.ma.filled(data[radar.get_slice(sweep)][rays][:, gates], -np.inf)
+        composite[:, in_range] = np.maximum(composite[:, in_range], samples)
+    return np.ma.masked_invalid(composite)
+
+
+def hail_class_composite(radar, field, hail_classes=HAIL_CLASSES):
+    """
+    Classification of sweep 0, with the largest hail class found anywhere
+    above a column replacing the class of that column.
+
+    A plain maximum would also promote classes which are not ordered by
+    size (i.e. big drops over graupel), so only the hail classes compete.
+
+    Returns
+    -------
+    composite : MaskedArray
+        (rays of sweep 0, ngates) classification.
+
+    """
+    data = radar.fields[field]['data']
+    composite = np.ma.array(data[radar.get_slice(0)], copy=True)
+    largest = np.zeros(composite.shape, dtype=composite.dtype)
+    for sweep, (rays, in_range, gates) in enumerate(geometry.sweep_columns(radar)):
+        samples = np.ma.filled(data[radar.get_slice(sweep)][rays][:, gates], 0)
+        samples = np.where(np.isin(samples, hail_classes), samples, 0)
+        largest[:, in_range] = np.maximum(largest[:, in_range], samples)
+    hail = largest > 0
+    composite[hail] = largest[hail]
+    return composite
+
+
+def lowest_sweep_composite(radar, fields):
+    """
+    Sweep 0 of a volume with fields replaced by their vertical composites.
+
+    Parameters
+    ----------
+    radar : Radar
+        Py-ART radar volume.
+    fields : dict
+        Field name to composite function, i.e. {'HDR': column_max}.
+        Fields missing from the radar are skipped.
+
+    Returns
+    -------
+    composite : Radar
+        Single sweep radar.
+
+    """
+    composite = radar.extract_sweeps([0])
+    for field, method in fields.items():
+        if field in radar.fields:
+            composite.fields[field]['data'] = method(radar, field)
+    return composite
+
+
+def benchmark(radar, repeat=3):
+    """
+    Time the lowest sweep composite of HDR and HSDA against extracting
+    sweep 0, the path taken when only the lowest sweep is processed.
+
+    Returns
+    -------
+    seconds : dict
+        'sweep_0', 'composite_first' (filling the geometry caches when the
+        station has not been seen before) and 'composite' (the fastest of
+        repeat runs after that).
+
+    """
+    fields = {'HDR': column_max, 'HCA_HSDA': hail_class_composite}
+    start = time.perf_counter()
+    lowest_sweep_composite(radar, fields)
+    seconds = {'composite_first': time.perf_counter() - start}
+    for name, reduce in (('sweep_0', lambda: radar.extract_sweeps([0])),
+                         ('composite', lambda: lowest_sweep_composite(radar, fields))):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            reduce()
+            best = min(best, time.perf_counter() - start)
+        seconds[name] = best
+    return seconds
+
+
+def _synthetic_volume(nsweeps):
+    """VCP 212 like volume of random HDR and HSDA classes"""
+    from pyart.testing import make_empty_ppi_radar
+
+    rays, gates = 720, 1832
+    radar = make_empty_ppi_radar(gates, rays, nsweeps)
+    angles = np.array([0.5, 0.9, 1.3, 1.8, 2.4, 3.1, 4.0, 5.1, 6.4, 8.0, 10.0, 12.5, 15.6, 19.5])[:nsweeps]
+    radar.fixed_angle['data'] = angles
+    radar.elevation['data'] = np.repeat(angles, rays)
+    radar.azimuth['data'] = np.tile((np.arange(rays) + 0.5) * 360. / rays, nsweeps)
+    radar.range['data'] = 2125. + 250. * np.arange(gates)
+    rng = np.random.RandomState(0)
+    radar.add_field('HDR', {'data': np.ma.masked_less(rng.uniform(-20, 60, (radar.nrays, gates)), 0)})
+    radar.add_field('HCA_HSDA', {'data': rng.randint(0, 14, (radar.nrays, gates))})
+    return radar
+
+
+if __name__ == "__main__":
+    nsweeps = int(sys.argv[1]) if len(sys.argv) > 1 else 14
+    results = benchmark(_synthetic_volume(nsweeps))
+    for name, seconds in results.items():
+        print("{:<16} {:.3f}s".format(name, seconds))
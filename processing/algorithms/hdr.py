@@ -3,6 +3,10 @@ Refernce Hail Detection with a Differential Reflectivity Radar (Bringi, 1984)
 """
 import logging
 
+import numpy as np
+
+_ZDR_MAX = 1.74  # dB, above which gzdr is set to 60
+
 
 class HailDifferentialReflectivity:
     _HDR_MIN = 27  # dB
@@ -22,32 +26,50 @@ class HailDifferentialReflectivity:
             logging.error("Radar must be set before calculation")
             return
 
-        def _calculate(zdr):
-            """Calculate the altered differential reflectivity.
-            gzdr is the corrected data accounting for lower reflectivity of hail."""
-            gzdr = (19 * zdr) + 27
-            gzdr[zdr <= 0] = 27
-            gzdr[zdr > 1.74] = 60
-            return gzdr
-
-        z = self._radar.fields['reflectivity']['data']
-        zdr = self._radar.fields['differential_reflectivity']['data']
-        gzdr = _calculate(zdr)
-        hdr = (z - gzdr)
-        self._radar.add_field(
+        hdr = calculate_hdr(self._radar.fields['reflectivity']['data'],
+                            self._radar.fields['differential_reflectivity']['data'])
+        self._add_field(self._radar, hdr)
+
+    @classmethod
+    def _add_field(cls, radar, hdr):
+        radar.add_field(
             'HDR',
             {
                 'units': 'dB',
                 'standard_name': 'HDR',
                 'long_name': 'Hail Differential Reflectivity',
-                'valid_max': self._HDR_MAX,
-                'valid_min': self._HDR_MIN,
+                'valid_max': cls._HDR_MAX,
+                'valid_min': cls._HDR_MIN,
                 'coordinates': 'elevation azimuth range',
                 '_FillValue': -9999.,
                 'data': hdr
             }
         )
 
+    @classmethod
+    def apply_batch(cls, radars):
+        """Calculate HDR for several radars with the same geometry in one call.
+
+        The reflectivity and differential reflectivity of every radar (i.e.
+        consecutive scans or sweeps of one station) are stacked and run
+        through calculate_hdr together, then each radar gets its slice of
+        the result as its HDR field.
+
+        return list of the radars with HDR added
+        """
+        radars = list(radars)
+        if len(radars) == 0:
+            return radars
+        shapes = {radar.fields['reflectivity']['data'].shape for radar in radars}
+        if len(shapes) != 1:
+            raise ValueError("Batched radars must share a geometry, got shapes {}".format(shapes))
+        z = np.ma.stack([radar.fields['reflectivity']['data'] for radar in radars])
+        zdr = np.ma.stack([radar.fields['differential_reflectivity']['data'] for radar in radars])
+        hdr = calculate_hdr(z, zdr)
+        for idx, radar in enumerate(radars):
+            cls._add_field(radar, hdr[idx])
+        return radars
+
     def get_radar(self):
         if self._radar is None:
             logging.error("Radar must be set before calculation")
@@ -58,3 +80,33 @@ class HailDifferentialReflectivity:
     def set_radar(self, radar):
         self._radar = radar
         self._apply()
+
+
+def calculate_hdr(z, zdr, out=None):
+    """Calculate HDR = Z - gzdr for reflectivity and differential reflectivity
+    arrays of any (matching) shape in a single float32 buffer.
+
+    gzdr is the corrected data accounting for lower reflectivity of hail,
+    19 * zdr + 27 clipped below at 27 (zdr <= 0) and set to 60 where
+    zdr > 1.74. It is evaluated in place so the only full size temporaries
+    are the result and its mask.
+
+    # Arguments:
+        z: MaskedArray
+            reflectivity (dBZ)
+        zdr: MaskedArray
+            differential reflectivity (dB)
+        out: ndarray
+            optional float32 buffer of the same shape to hold the result
+
+    return MaskedArray of HDR (dB), masked where either input is
+    """
+    zdr_data = np.ma.getdata(zdr)
+    gzdr = out if out is not None else np.empty(np.shape(zdr_data), dtype=np.float32)
+    np.multiply(zdr_data, 19, out=gzdr, casting='unsafe')
+    gzdr += 27
+    np.maximum(gzdr, 27, out=gzdr)
+    np.putmask(gzdr, zdr_data > _ZDR_MAX, 60)
+    np.subtract(np.ma.getdata(z), gzdr, out=gzdr, casting='unsafe')
+    mask = np.ma.getmaskarray(z) | np.ma.getmaskarray(zdr)
+    return np.ma.masked_array(gzdr, mask=mask, copy=False)
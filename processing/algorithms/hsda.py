@@ -4,13 +4,14 @@
 import logging
 
 import numpy as np
-import wradlib as wrl
 
 from processing.algorithms import common, hsda_mf
+from processing.algorithms.kdp import kdp_from_phidp
 from processing.cpol_processing import hydrometeors, radar_codes
+from processing.utils import geometry
 
 
-def main(radar, _sonde, gatefilter, srtm, hca_hail_idx=[9], dzdr=0):
+def main(radar, _sonde, gatefilter, srtm, hca_hail_idx=[9], dzdr=0, kdp_winlen=7):
     """
     Wrapper function for HSDA processing
 
@@ -28,6 +29,8 @@ def main(radar, _sonde, gatefilter, srtm, hca_hail_idx=[9], dzdr=0):
         index of hail related fields in classification to apply HSDA
     dzdr:
         offset for differential reflectivity
+    kdp_winlen:
+        number of gates in the KDP regression window (odd)
 
     Returns:
     ========
@@ -71,11 +74,12 @@ def main(radar, _sonde, gatefilter, srtm, hca_hail_idx=[9], dzdr=0):
 
     # Add KDP
     logging.info("Start KDP")
-    kdp = wrl.dp.kdp_from_phidp(
-        phidp=radar.fields['differential_phase']['data'])
+    kdp = kdp_from_phidp(radar.fields['differential_phase']['data'],
+                         rhohv=radar.fields['cross_correlation_ratio']['data'],
+                         winlen=kdp_winlen)
     kdp_dict = {'data': kdp, 'units': '%',
                 'long_name': 'Specific Differential Phase',
-                'standard_name': 'KDP', 'comments': "wradlib calculated kdp"}
+                'standard_name': 'KDP', 'comments': "sliding least squares kdp on precipitation gates"}
     radar.add_field('KDP', kdp_dict, replace_existing=True)
     logging.info("KDP Complete")
 
@@ -113,10 +117,8 @@ def main(radar, _sonde, gatefilter, srtm, hca_hail_idx=[9], dzdr=0):
 
     q = hsda_q(radar.fields['reflectivity']['data'], phi_cf,
                rhv_cf_smooth, snr_cf, cbb_cf, cbb_threshold=0.5)
-    # calc pixel alt
-    rg, azg = np.meshgrid(radar.range['data'], radar.azimuth['data'])
-    rg, eleg = np.meshgrid(radar.range['data'], radar.elevation['data'])
-    _, _, alt = common.antenna_to_cartesian(rg / 1000.0, azg, eleg)
+    # calc pixel alt, cached per station geometry
+    alt = geometry.gate_heights(radar)
 
     # find all pixels in hca which match the hail classes
     # for each pixel, apply transform
@@ -0,0 +1,115 @@
+"""
+Fast KDP estimation from differential phase.
+
+Drop in replacement for wradlib.dp.kdp_from_phidp used by HSDA. The
+sliding least squares fit of PHIDP against range is evaluated from
+cumulative sums, so every window costs the same regardless of its length,
+gates which are masked or have a low RHOHV are left out of the fit, rays
+without enough valid gates are skipped entirely and the remaining rays are
+processed in parallel chunks.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def kdp_from_phidp(phidp, rhohv=None, winlen=7, dr=1., min_rhohv=0.8, workers=None):
+    """
+    Estimate KDP as half the range derivative of PHIDP.
+
+    Parameters
+    ----------
+    phidp : ndarray
+        Differential phase (deg), range is the last dimension. Masked and
+        NaN gates are treated as missing.
+    rhohv : ndarray
+        Cross correlation ratio with the same shape as phidp. Gates below
+        min_rhohv are treated as missing. Optional.
+    winlen : int
+        Number of gates in the regression window (must be odd).
+    dr : float
+        Gate length (km), same meaning as in wradlib.
+    min_rhohv : float
+        Lowest RHOHV considered to be precipitation.
+    workers : int
+        Threads used across rays, defaults to the number of CPUs.
+
+    Returns
+    -------
+    kdp : MaskedArray
+        Specific differential phase (deg/km), masked where no fit was possible.
+
+    """
+    assert (winlen % 2) == 1, 'winlen must be an odd number.'
+    shape = np.shape(phidp)
+    phi = np.ma.masked_invalid(phidp).astype(np.float64).reshape((-1, shape[-1]))
+    valid = ~np.ma.getmaskarray(phi)
+    if rhohv is not None:
+        rho = np.ma.filled(np.ma.masked_invalid(rhohv).reshape(phi.shape), 0.)
+        valid &= rho >= min_rhohv
+    values = np.ma.filled(phi, 0.)
+    min_valid = winlen // 2 + 1
+
+    kdp = np.full(phi.shape, np.nan)
+    rays = np.flatnonzero(np.count_nonzero(valid, axis=1) >= min_valid)
+    if len(rays) > 0:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        chunks = [chunk for chunk in np.array_split(rays, workers) if len(chunk) > 0]
+
+        def _run(chunk):
+            return _sliding_slope(values[chunk], valid[chunk], winlen, min_valid)
+
+        with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+            for chunk, (start, slope) in zip(chunks, pool.map(_run, chunks)):
+                kdp[chunk, start:start + slope.shape[1]] = slope
+
+    kdp /= 2. * dr
+    return np.ma.masked_invalid(kdp.reshape(shape))
+
+
+def _sliding_slope(y, valid, winlen, min_valid):
+    """
+    Least squares slope of y over a centred window for each valid gate.
+
+    Only the span of gates between the first and last valid gate of the
+    chunk is evaluated.
+
+    Returns
+    -------
+    start : int
+        Index of the first gate of the evaluated span.
+    slope : ndarray
+        Slope (per gate) for the span, NaN where it is undefined.
+
+    """
+    cols = np.flatnonzero(valid.any(axis=0))
+    start, stop = cols[0], cols[-1] + 1
+    y = y[:, start:stop]
+    w = valid[:, start:stop].astype(np.float64)
+    ngates = y.shape[1]
+
+    half = winlen // 2
+    idx = np.arange(ngates)
+    lo = np.clip(idx - half, 0, ngates)
+    hi = np.clip(idx + half + 1, 0, ngates)
+    x = idx.astype(np.float64)
+
+    def _window_sum(a):
+        csum = np.zeros((a.shape[0], ngates + 1))
+        np.cumsum(a, axis=1, out=csum[:, 1:])
+        return csum[:, hi] - csum[:, lo]
+
+    wy = w * y
+    n = _window_sum(w)
+    sx = _window_sum(w * x)
+    sy = _window_sum(wy)
+    sxx = _window_sum(w * (x * x))
+    sxy = _window_sum(wy * x)
+
+    den = n * sxx - sx * sx
+    good = valid[:, start:stop] & (n >= min_valid) & (den > 0)
+    slope = np.full(y.shape, np.nan)
+    slope[good] = (n * sxy - sx * sy)[good] / den[good]
+    return start, slope
@@ -0,0 +1,127 @@
+"""
+Triage of a scan before the hail algorithms run on it.
+
+A few statistics of the lowest sweep decide whether a scan can hold any
+hail at all. Scans without a single strong echo are skipped before HDR,
+HSDA and MEHS are run and contoured, and the reason is recorded so the
+time saved per day can be reported.
+"""
+import logging
+from collections import Counter, namedtuple
+
+import numpy as np
+
+Z_HAIL = 40.  # dBZ, below which MESH gives no weight to an echo
+Z_CORE = 45.  # dBZ
+MIN_CORE_GATES = 10
+ZDR_RANGE = (-2., 8.)  # dB, sane median differential reflectivity of strong echoes
+RHOHV_RANGE = (0.5, 1.05)  # sane median cross correlation ratio of strong echoes
+
+TriageResult = namedtuple('TriageResult', ['reason', 'detail', 'dual_pol', 'stats'])
+TriageResult.__doc__ = """reason is None when the scan should be processed, otherwise the
+category it was skipped for with detail giving the numbers. dual_pol
+is False when ZDR or RHOHV of the strong echoes are missing or not
+sane, in which case HDR and HSDA should not be run."""
+
+
+class Triage:
+    """Cheap checks of the lowest sweep of a scan
+
+    # Arguments:
+        z_hail: float
+            skip scans whose maximum reflectivity (dBZ) is below this
+        z_core: float
+            reflectivity (dBZ) of a hail core
+        min_core_gates: int
+            skip scans with fewer gates than this at or above z_core
+    """
+
+    def __init__(self, z_hail=Z_HAIL, z_core=Z_CORE, min_core_gates=MIN_CORE_GATES):
+        self.z_hail = z_hail
+        self.z_core = z_core
+        self.min_core_gates = min_core_gates
+
+    def check(self, radar):
+        """return TriageResult for the lowest sweep of radar"""
+        sweep = radar.get_slice(0)
+        if 'reflectivity' not in radar.fields:
+            return TriageResult('no reflectivity', 'reflectivity field missing', False, {})
+        z = np.ma.masked_invalid(radar.fields['reflectivity']['data'][sweep])
+        if z.count() == 0:
+            return TriageResult('no reflectivity', 'every gate masked', False, {})
+
+        strong = np.ma.filled(z >= self.z_hail, False)
+        stats = {
+            'max_reflectivity': float(z.max()),
+            'hail_gates': int(np.count_nonzero(strong)),
+            'core_gates': int(np.count_nonzero(np.ma.filled(z >= self.z_core, False)))
+        }
+        if stats['max_reflectivity'] < self.z_hail:
+            return TriageResult('weak echo', 'max reflectivity {:.1f} dBZ below {} dBZ'.format(
+                stats['max_reflectivity'], self.z_hail), False, stats)
+        if stats['core_gates'] < self.min_core_gates:
+            return TriageResult('small core', '{} gates at or above {} dBZ'.format(
+                stats['core_gates'], self.z_core), False, stats)
+
+        stats['zdr'] = self._median(radar, 'differential_reflectivity', sweep, strong)
+        stats['rhohv'] = self._median(radar, 'cross_correlation_ratio', sweep, strong)
+        dual_pol = (stats['zdr'] is not None and stats['rhohv'] is not None
+                    and ZDR_RANGE[0] <= stats['zdr'] <= ZDR_RANGE[1]
+                    and RHOHV_RANGE[0] <= stats['rhohv'] <= RHOHV_RANGE[1])
+        return TriageResult(None, None, dual_pol, stats)
+
+    @staticmethod
+    def _median(radar, field, sweep, gates):
+        """Median of field over gates of the sweep, None when there is no data"""
+        if field not in radar.fields:
+            return None
+        values = np.ma.masked_invalid(radar.fields[field]['data'][sweep])[gates]
+        if values.count() == 0:
+            return None
+        return float(np.ma.median(values))
+
+
+class TriageReport:
+    """Counts of skipped and processed scans per day and the time saved"""
+
+    def __init__(self):
+        self._days = {}
+
+    def _day(self, day):
+        if day not in self._days:
+            self._days[day] = {'processed': 0, 'skipped': Counter(), 'triage_seconds': 0.,
+                               'processing_seconds': 0.}
+        return self._days[day]
+
+    def skipped(self, day, reason, triage_seconds):
+        counts = self._day(day)
+        counts['skipped'][reason] += 1
+        counts['triage_seconds'] += triage_seconds
+
+    def processed(self, day, triage_seconds, processing_seconds):
+        counts = self._day(day)
+        counts['processed'] += 1
+        counts['triage_seconds'] += triage_seconds
+        counts['processing_seconds'] += processing_seconds
+
+    def summary(self, day):
+        """return dict of the day's counts, with the time saved estimated
+        as the skipped scans at the day's mean processing time less the
+        time spent on triage"""
+        counts = self._day(day)
+        skipped = sum(counts['skipped'].values())
+        mean = counts['processing_seconds'] / counts['processed'] if counts['processed'] else 0.
+        return {
+            'day': day,
+            'processed': counts['processed'],
+            'skipped': skipped,
+            'reasons': dict(counts['skipped']),
+            'triage_seconds': counts['triage_seconds'],
+            'saved_seconds': skipped * mean - counts['triage_seconds']
+        }
+
+    def log(self):
+        for day in sorted(self._days):
+            summary = self.summary(day)
+            logging.info("triage {day}: processed={processed} skipped={skipped} reasons={reasons} "
+                         "triage t={triage_seconds:.1f} saved t={saved_seconds:.1f}".format(**summary))
@@ -23,6 +23,7 @@ Codes for correcting and estimating various radar and meteorological parameters.
 """
 import datetime
 import fnmatch
+import hashlib
 # Python Standard Library
 import os
 import re
@@ -32,6 +33,10 @@ import numpy as np
 # Other Libraries
 import pyart
 
+from processing.utils import geometry
+
+_sounding_cache = geometry.LRUCache()
+
 
 def _my_snr_from_reflectivity(radar, refl_field='DBZ'):
     """
@@ -429,6 +434,64 @@ def read_radar(radar_file_name):
     return radar
 
 
+def _sonde_key(sonde):
+    """
+    Identify a sounding by station and launch time, falling back on a digest
+    of its profile when those attributes were lost (i.e. after pickling).
+    """
+    station = getattr(sonde, 'station', None)
+    date = getattr(sonde, 'date', None)
+    if station is not None and date is not None:
+        return (station, date)
+    digest = hashlib.sha1()
+    digest.update(np.asarray(sonde['height'], dtype=np.float64).tobytes())
+    digest.update(np.asarray(sonde['temperature'], dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def _sounding_to_gates(radar, sonde):
+    """
+    Interpolate the sounding temperature on to the radar gates. Gate heights
+    are cached per station geometry and the result per (sounding, geometry),
+    so consecutive scans of a station reuse both. Heights are relative to the
+    antenna, as with the previous altitude hack around map_profile_to_gates.
+
+    Returns:
+    ========
+        z_dict: dict
+            Altitude in m, interpolated at each radar gates.
+        temp_info_dict: dict
+            Temperature in Celsius, interpolated at each radar gates.
+    """
+    key = geometry.geometry_key(radar)
+    sonde_key = (_sonde_key(sonde), key)
+    cached = _sounding_cache.get(sonde_key)
+    if cached is None:
+        heights = geometry.gate_heights(radar, key)
+        temperatures = np.asarray(sonde['temperature'], dtype=np.float64)
+        snd_heights = np.asarray(sonde['height'], dtype=np.float64)
+        # CPOL altitude is 50 m.
+        good = (snd_heights >= 0) & (temperatures >= -100) & (temperatures <= 100)
+        order = np.argsort(snd_heights[good])
+        snd_heights = snd_heights[good][order]
+        temperatures = temperatures[good][order]
+
+        temp = np.interp(heights, snd_heights, temperatures)
+        # Gates above the top of the sounding are not extrapolated
+        temp = np.ma.masked_where(heights > snd_heights[-1], temp)
+        cached = _sounding_cache.put(sonde_key, (heights, temp))
+
+    heights, temp = cached
+    z_dict = pyart.config.get_metadata('height')
+    z_dict['data'] = heights
+    temp_info_dict = {'data': temp,
+                      'long_name': 'Sounding temperature at gate',
+                      'standard_name': 'temperature',
+                      'valid_min': -100, 'valid_max': 100,
+                      'units': 'degrees Celsius'}
+    return z_dict, temp_info_dict
+
+
 def snr_and_sounding(radar, sonde, refl_field_name='DBZ', temp_field_name="temp"):
     """
     Compute the signal-to-noise ratio as well as interpolating the radiosounding
@@ -454,33 +517,9 @@ def snr_and_sounding(radar, sonde, refl_field_name='DBZ', temp_field_name="temp"
             Signal to noise ratio.
     """
     radar_start_date = netCDF4.num2date(radar.time['data'][0], radar.time['units'])
-    # Altitude hack.
-    true_alt = radar.altitude['data'].copy()
-    radar.altitude['data'] = np.array([0])
-    temperatures = sonde['temperature']
-    temperatures = np.where(~temperatures.between(-100, 100), np.nan, temperatures)
-    try:
-        temperatures = temperatures.filled(np.nan)
-    except AttributeError:
-        pass
-    # times = interp_sonde.variables['time'][:]
-    # heights = interp_sonde.variables['height'][:]
-
-    # CPOL altitude is 50 m.
-    good_altitude = sonde['height'] >= 0
-    # Getting the temperature
-    z_dict, temp_dict = pyart.retrieve.map_profile_to_gates(temperatures[good_altitude],
-                                                            sonde['height'][good_altitude],
-                                                            radar)
-    temp_info_dict = {'data': temp_dict['data'],
-                      'long_name': 'Sounding temperature at gate',
-                      'standard_name': 'temperature',
-                      'valid_min': -100, 'valid_max': 100,
-                      'units': 'degrees Celsius',
-                      'comment': 'Radiosounding date: %s' % (radar_start_date.strftime("%Y/%m/%d"))}
+    z_dict, temp_info_dict = _sounding_to_gates(radar, sonde)
+    temp_info_dict['comment'] = 'Radiosounding date: %s' % (radar_start_date.strftime("%Y/%m/%d"))
 
-    # Altitude hack
-    radar.altitude['data'] = true_alt
     # Calculate SNR
     snr = pyart.retrieve.calculate_snr_from_reflectivity(radar, refl_field=refl_field_name)
     # Sometimes the SNR is an empty array, this is due to the toa parameter.
@@ -6,9 +6,11 @@ import logging
 import os
 import pickle
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timedelta
 
 import pyart.map.grid_mapper
+from bson import ObjectId
 
 ''' NEXRAD and Radiosonde Stations Lists '''
 from processing.utils.nexrad_stations import _radar_stations as radar_stations
@@ -17,15 +19,23 @@ from processing.utils.radiosonde_mappings import _radiosonde_station as _station
 ''' Downloaders and Data References '''
 from processing.downloaders.nexrad_downloader import RadarDownloader
 from processing.downloaders.sonde_downloader import SondeDownloader
-from processing.utils.srtm.srtm import srtm
+from processing.utils.srtm.srtm import srtm, prepare as srtm_prepare
 
 ''' Algorithms '''
 from processing.algorithms.hdr import HailDifferentialReflectivity
 from processing.algorithms.hsda import main as hsda_main
 from processing.algorithms.mehs import MaximumExpectedHailSize
+from processing.algorithms.composite import column_max, hail_class_composite, lowest_sweep_composite
+from processing.algorithms.triage import Triage, TriageReport
 
 ''' Conversion and Exporting Utilities '''
+from processing.utils import geometry
 from processing.utils.geojson_converter import GeoJSONConverter
+from processing.utils.mosaic import Mosaic, STATION as MOSAIC_STATION
+from processing.utils.swath import DailySwath
+from processing.utils.delta import DeltaEncoder, REFS_SUFFIX
+from processing.export.tiles import TileCache
+from processing.export.columnar import PERIODS as COLUMNAR_PERIODS, product_path, write_features
 import processing.db.db_connection as db
 
 
@@ -38,7 +48,11 @@ class Data:
     If an invalid format is passed, class will default to the parameters established in __init__
     '''
 
-    def __init__(self, start_date, end_date=None, stations=None, HSDA=False):
+    def __init__(self, start_date, end_date=None, stations=None, HSDA=False, mehs_engine='grid',
+                 mehs_adaptive=False, mosaic=False, swath=False, sweeps='lowest', index_contours=False,
+                 simplify=None, quantize=False, triage=False, contour_workers=1,
+                 upload_batch=None, tiles=None, columnar=None, columnar_period='scan',
+                 delta=False):
         # Init Date Range
         self._start_date = start_date
         self._end_date = end_date
@@ -51,6 +65,44 @@ class Data:
         if self._stations is None:
             self._stations = radar_stations
         self.HSDA = HSDA
+        # 'lowest' processes sweep 0 only, 'all' the whole volume with HDR and HSDA
+        # contoured as vertical composites on sweep 0
+        if sweeps not in ('lowest', 'all'):
+            raise ValueError("sweeps must be 'lowest' or 'all', got {}".format(sweeps))
+        self.sweeps = sweeps
+        self.mehs_engine = mehs_engine
+        # Contour in array index space and only transform the vertices to lat/lon
+        self.index_contours = index_contours
+        # Simplification tolerance (m) of contours and whether to delta encode their coordinates
+        self.simplify = simplify
+        self.quantize = quantize
+        # Processes contouring the products of a batch, uploads stay in this process
+        self.contour_workers = contour_workers
+        self._contour_pool = None
+        # Features inserted per insert_many while contouring, None uploads each product whole
+        if upload_batch is not None and upload_batch < 3:
+            raise ValueError("upload_batch must be at least 3, got {}".format(upload_batch))
+        self.upload_batch = upload_batch
+        # MBTiles file kept up to date with vector tiles of every uploaded product
+        self._tiles = TileCache(tiles) if tiles is not None else None
+        # Directory every uploaded product is also written to as a columnar file, per 'scan' or 'hour'
+        if columnar_period not in COLUMNAR_PERIODS:
+            raise ValueError("columnar_period must be one of {}, got {}".format(COLUMNAR_PERIODS, columnar_period))
+        self.columnar = columnar
+        self.columnar_period = columnar_period
+        # Levels unchanged since a station's last scan are stored as references, see processing.utils.delta
+        self._delta = DeltaEncoder() if delta else None
+        self.mehs_adaptive = mehs_adaptive
+        # MESH of every station is composited and contoured once per time window
+        self._mosaic = Mosaic() if mosaic else None
+        # Running daily maximum of MESH, contoured on demand with DailySwath(day).contour()
+        self._swath = swath
+        self._swaths = {}
+        # Skip scans whose lowest sweep cannot hold hail before running the algorithms
+        self._triage = Triage() if triage else None
+        self._triage_report = TriageReport()
+        if self.HSDA:
+            srtm_prepare(self._stations)
 
         # Init downloader
         self.sonde_pickles = []  # pickle array
@@ -100,8 +152,7 @@ class Data:
                 for _idx, radarfile in enumerate(
                         self._radar_downloader._radars):  ## Modifying calls so RAM doesnt get killed
                     if count < tracker:
-                        radar = self._radar_downloader.get_radar(_idx)
-                        radar = radar.extract_sweeps([0])
+                        radar = self._select_sweeps(self._radar_downloader.get_radar(_idx))
                         self.proc_helper(radar, _idx, sondes)
                         count += 1
                     else:
@@ -109,7 +160,7 @@ class Data:
                         self._processed_radars = []
                         self._processed_grids = []
                         ## Start next objs
-                        radar = self._radar_downloader.get_radar(_idx)
+                        radar = self._select_sweeps(self._radar_downloader.get_radar(_idx))
                         self.proc_helper(radar, idx, sondes)
                         count = 1
 
@@ -123,6 +174,22 @@ class Data:
                 with open(self.sonde_pickles[idx], "wb") as f:
                     pickle.dump(all_sondes, f)
 
+        if self._mosaic is not None:
+            self._gen_mosaic_json()
+        if self._triage is not None:
+            self._triage_report.log()
+        if self._contour_pool is not None:
+            self._contour_pool.shutdown()
+            self._contour_pool = None
+        if self._tiles is not None:
+            self._tiles.close()
+
+    def _select_sweeps(self, radar):
+        ''' Reduces a volume to the sweeps being processed '''
+        if self.sweeps == 'lowest':
+            return radar.extract_sweeps([0])
+        return radar
+
     def proc_helper(self, radar, idx, sondes):
         if sondes is not None:
             alts = sondes[1]
@@ -130,40 +197,88 @@ class Data:
             alts = None
         radar_date = self._radar_downloader.get_collection_time(idx)
         radar_id = self._radar_downloader.get_radar_id(idx)
-        
+
+        # Triage
+        start = time.time()
+        dual_pol = True
+        if self._triage is not None:
+            result = self._triage.check(radar)
+            if result.reason is not None:
+                logging.info("skipping {} at {}: {}".format(radar_id, radar_date, result.detail))
+                self._triage_report.skipped(radar_date.date(), result.reason, time.time() - start)
+                return
+            dual_pol = result.dual_pol
+            if not dual_pol:
+                logging.info("ZDR/RHOHV of {} not sane {}, skipping HDR and HSDA".format(radar_id, result.stats))
+        triage_time = time.time() - start
+
         # Apply HDR
-        logging.info("applying HDR")
-        radar = HailDifferentialReflectivity(radar).get_radar()
+        start = time.time()
+        if dual_pol:
+            logging.info("applying HDR")
+            radar = HailDifferentialReflectivity(radar).get_radar()
         if alts is not None:
             # Apply HSDA
             srtm_file = srtm(radar.metadata['instrument_name'])
-            if self.HSDA and os.path.isfile(srtm_file):
+            if dual_pol and self.HSDA and os.path.isfile(srtm_file):
                 logging.info("applying HSDA")
                 gatefilter = pyart.filters.GateFilter(radar)
                 gatefilter.exclude_transition()
                 gatefilter.exclude_masked("reflectivity")
                 radar = self.proc_hsda(radar, gatefilter, srtm_file, sondes)
-            elif self.HSDA and not os.path.isfile(srtm_file):  # intentionally redundent
+            elif dual_pol and self.HSDA and not os.path.isfile(srtm_file):  # intentionally redundent
                 logging.warning('No srtm data found to calulate hsda, skipping calc')
-            product = {
-                'id': radar_id,
-                'radar': radar,
-                'timestamp': radar_date
-            }
-            self._processed_radars.append(product)
+            logging.info("HDR/HSDA over {} sweep(s) t={}".format(radar.nsweeps, time.time() - start))
+            if dual_pol:
+                product = {
+                    'id': radar_id,
+                    'radar': self._composite(radar),
+                    'timestamp': radar_date
+                }
+                self._processed_radars.append(product)
             
             # Apply MEHS
             logging.info("applying MEHS")
             
-            mesh = MaximumExpectedHailSize(radar, alts)
-            product = {
-                'id': radar_id,
-                'grid': mesh.get_grid(),
-                'timestamp': radar_date
-            }
-            self._processed_grids.append(product)
+            mesh = MaximumExpectedHailSize(radar, alts, engine=self.mehs_engine,
+                                           adaptive=self.mehs_adaptive).get_mesh()
+            if mesh is not None and self._swath:
+                self._update_swath(mesh, radar_date)
+            if mesh is not None and self._mosaic is not None:
+                self._mosaic.add(radar_id, *mesh, radar_date)
+            elif mesh is not None:
+                product = {
+                    'id': radar_id,
+                    'mesh': mesh,
+                    'timestamp': radar_date
+                }
+                self._processed_grids.append(product)
+            else:
+                logging.info("no echoes above the MEHS z_min, skipping MEHS")
             
             mesh, alts = None, None
+        self._triage_report.processed(radar_date.date(), triage_time, time.time() - start)
+
+    def get_triage_report(self):
+        ''' Summary per day of the scans triage skipped and the time it saved '''
+        return self._triage_report
+
+    def _update_swath(self, mesh, radar_date):
+        ''' Folds a scan's MESH in to the swath of its day '''
+        day = radar_date.date()
+        if day not in self._swaths:
+            self._swaths[day] = DailySwath(day)
+        cells = self._swaths[day].update(*mesh, radar_date)
+        logging.info("MESH swath for {} raised in {} cells".format(day, cells))
+
+    def _composite(self, radar):
+        ''' Reduces a volume's HDR and HSDA to sweep 0 for contouring '''
+        if radar.nsweeps == 1:
+            return radar
+        start = time.time()
+        composite = lowest_sweep_composite(radar, {'HDR': column_max, 'HCA_HSDA': hail_class_composite})
+        logging.info("vertical composite of {} sweeps t={}".format(radar.nsweeps, time.time() - start))
+        return composite
 
     def proc_hsda(self, radar, gatefilter, srtm_file, sondes):
         ''' Method to apply HSDA to radar data '''
@@ -171,17 +286,31 @@ class Data:
         radar.add_field('HCA_HSDA', hsda_meta, replace_existing=True)
         return radar
 
+    def _product_arrays(self, radar, algo):
+        ''' (data, lats, lons) of a processed product to contour '''
+        if algo == 'MESH':
+            # MESH coordinates are (lon, lat), passed in the lats, lons slots as before
+            return radar['mesh']
+        return self._extract_data_lat_lon(radar['radar'], algo)
+
+    def _contour_options(self):
+        ''' Keyword arguments of GeoJSONConverter shared by every product '''
+        return {'index_space': self.index_contours, 'simplify': self.simplify, 'quantize': self.quantize}
+
     def _gen_json_helper(self, radar, algo, collection, clevels=None):
         ''' Helper method which converts radar objects to GeoJSON then
         exports them to the db '''
-        if algo == 'MESH':
-            data, lats, lons = self._extract_data_lat_lon(radar['grid'], algo)
-        else:
-            data, lats, lons = self._extract_data_lat_lon(radar['radar'], algo)
+        data, lats, lons = self._product_arrays(radar, algo)
+        # Delta mode hashes whole levels, so products are not streamed with it
+        stream = self.upload_batch is not None and self._delta is None
         converter = GeoJSONConverter(
             data, lats, lons,
-            algo, radar['id'], radar['timestamp'], levels=clevels)
-        self._upload_product(converter, collection)
+            algo, radar['id'], radar['timestamp'], levels=clevels, stream=stream, **self._contour_options())
+        if stream:
+            self._upload_stream(converter, collection)
+        else:
+            self._upload_product(converter.get_features(), converter.get_metadata(),
+                                 converter.get_relational_id(), collection)
 
     def _gen_json(self):
         '''Converts all processed radars in self._processed_radars to
@@ -198,39 +327,157 @@ class Data:
 
         ''' Contour, convert, and export GeoJSONs '''
         start = time.time()
-        for argument in arguments:
-            logging.info(argument)
-            if len(argument) > 3:
-                self._gen_json_helper(argument[0], argument[1], argument[2], argument[3])
-            else:
-                self._gen_json_helper(argument[0], argument[1], argument[2])
+        if self.contour_workers > 1:
+            self._gen_json_parallel(arguments)
+        else:
+            for argument in arguments:
+                logging.info(argument)
+                if len(argument) > 3:
+                    self._gen_json_helper(argument[0], argument[1], argument[2], argument[3])
+                else:
+                    self._gen_json_helper(argument[0], argument[1], argument[2])
 
         end = time.time()
         logging.info("end contouring. t={}".format(end - start))
 
-    def _upload_product(self, converter, algo_collection):
+    def _gen_json_parallel(self, arguments):
+        ''' Contours every product in the process pool and uploads each
+        as soon as it is done, one at a time from this process '''
+        if self._contour_pool is None:
+            self._contour_pool = ProcessPoolExecutor(max_workers=self.contour_workers)
+        jobs = {}
+        for argument in arguments:
+            radar, algo, collection = argument[:3]
+            clevels = argument[3] if len(argument) > 3 else None
+            data, lats, lons = self._product_arrays(radar, algo)
+            job = self._contour_pool.submit(
+                _contour_product, data, lats, lons, algo, radar['id'], radar['timestamp'], clevels,
+                self._contour_options())
+            jobs[job] = (radar['id'], algo, collection)
+        for job in as_completed(jobs):
+            station, algo, collection = jobs[job]
+            try:
+                features, metadata, relational_id = job.result()
+            except Exception:
+                logging.exception("contouring {} for {} failed".format(algo, station))
+                continue
+            self._upload_product(features, metadata, relational_id, collection)
+
+    def _gen_mosaic_json(self):
+        '''Contours the national MESH mosaic once per time window and
+        uploads it under the CONUS station'''
+        start = time.time()
+        for window, stations, mesh in self._mosaic.flush():
+            logging.info("contouring MESH mosaic of {} stations for {}".format(len(stations), window))
+            product = {
+                'id': MOSAIC_STATION,
+                'mesh': mesh,
+                'timestamp': window
+            }
+            self._gen_json_helper(product, 'MESH', 'algo_mehs')
+        end = time.time()
+        logging.info("end mosaic contouring. t={}".format(end - start))
+
+    def _upload_product(self, features, metadata, relational_id, algo_collection):
         ''' Takes GeoJSONs from GeoJSON converter and inserts
         in to database '''
-        features = converter.get_features()
-        if isinstance(features, list) and len(features) > 2:
+        uploaded = isinstance(features, list) and len(features) > 2
+        if uploaded:
             logging.info("feature_count={}".format(len(features)))
 
-            self._conn.hailtrace[algo_collection].insert_many(features)
-            self._conn.hailtrace['log_proc_events'].insert_one(converter.get_metadata())
+            inserted = features
+            if self._delta is not None:
+                inserted, references = self._delta.encode(features, metadata, relational_id)
+                if len(references) > 0:
+                    self._conn.hailtrace[algo_collection + REFS_SUFFIX].insert_many(references)
+                logging.info("delta: {} of {} features unchanged".format(len(features) - len(inserted),
+                                                                        len(features)))
+            if len(inserted) > 0:
+                self._conn.hailtrace[algo_collection].insert_many(inserted)
+            self._conn.hailtrace['log_proc_events'].insert_one(metadata)
+            self._write_columnar(features, metadata)
 
-            logging.info('processing done for {}'.format(converter.get_relational_id()))
+            logging.info('processing done for {}'.format(relational_id))
         else:
             logging.warning('no values to contour')
+        if self._tiles is not None:
+            # A product without contours clears the station's previous tiles
+            self._tiles.update(metadata['algorithm'], metadata['station'], features if uploaded else [])
+
+    def _upload_stream(self, converter, algo_collection):
+        ''' Inserts the features of a streaming GeoJSONConverter in
+        batches of self.upload_batch while the later levels are still
+        being contoured '''
+        metadata = converter.get_metadata()
+        tiles = self._tiles.updater(metadata['algorithm'], metadata['station']) if self._tiles is not None else None
+        columnar_path = self._columnar_path(metadata)
+        columnar_size = os.path.getsize(columnar_path) if columnar_path and os.path.isfile(columnar_path) else None
+        count = 0
+        # Ids of this upload's documents, the scan's id is shared with earlier uploads of it
+        inserted_ids = []
+        try:
+            for batch in converter.iter_batches(self.upload_batch):
+                if count == 0 and len(batch) <= 2:
+                    # The whole product, too few features to upload as in _upload_product
+                    break
+                for feature in batch:
+                    feature['_id'] = ObjectId()
+                inserted_ids.append([feature['_id'] for feature in batch])
+                self._conn.hailtrace[algo_collection].insert_many(batch)
+                if tiles is not None:
+                    tiles.add(batch)
+                self._write_columnar(batch, metadata)
+                count += len(batch)
+        except Exception:
+            # Remove the part of the product already uploaded, the tiles are left uncommitted
+            logging.exception("streaming {} for {} failed after {} features, removing them".format(
+                metadata['algorithm'], metadata['station'], count))
+            for ids in inserted_ids:
+                self._conn.hailtrace[algo_collection].delete_many({'_id': {'$in': ids}})
+            if columnar_path is not None:
+                if columnar_size is not None:
+                    os.truncate(columnar_path, columnar_size)
+                elif os.path.isfile(columnar_path):
+                    os.remove(columnar_path)
+            self._conn.hailtrace['log_proc_errors'].insert_one(dict(metadata, error='CONTOUR_FAILED'))
+            return
+        if tiles is not None:
+            tiles.commit()
+        if count == 0:
+            logging.warning('no values to contour')
+            return
+        logging.info("feature_count={}".format(count))
+        # Only recorded once every feature is in, a failed upload leaves no event behind
+        self._conn.hailtrace['log_proc_events'].insert_one(metadata)
+        logging.info('processing done for {}'.format(converter.get_relational_id()))
+
+    def _columnar_path(self, metadata):
+        ''' Columnar file of a product, None when not writing them '''
+        if self.columnar is None:
+            return None
+        return product_path(self.columnar, metadata['algorithm'], metadata['station'],
+                            metadata['collectiontime'], self.columnar_period)
+
+    def _write_columnar(self, features, metadata):
+        ''' Appends uploaded features to the product's columnar file '''
+        path = self._columnar_path(metadata)
+        if path is None:
+            return
+        try:
+            write_features(path, features, metadata['algorithm'])
+        except Exception:
+            # The product is already in the db, a failed export must not fail the scan
+            logging.exception("columnar write of {} failed".format(path))
 
     def _extract_data_lat_lon(self, radar, algo):
         ''' Function to get the processed data and lat, lon points
         from the radar object to be used in GeoJSONConverter for contouring'''
-        if algo == 'MESH':
-            # radar here is actually grid, name is radar for uniformity
-            radar.init_point_altitude()
-            lats, lons = radar.get_point_longitude_latitude()
-            data = radar.fields[algo]['data'][0]
-        else:
-            data = radar.get_field(0, algo, True)
-            lats, lons, _ = radar.get_gate_lat_lon_alt(0, False, True)
+        data = radar.get_field(0, algo, True)
+        lats, lons = geometry.gate_lat_lon(radar, 0, True)
         return data, lats, lons
+
+
+def _contour_product(data, lats, lons, algo, station, timestamp, levels, options):
+    ''' Runs GeoJSONConverter in a worker process, returning only what is uploaded '''
+    converter = GeoJSONConverter(data, lats, lons, algo, station, timestamp, levels=levels, **options)
+    return converter.get_features(), converter.get_metadata(), converter.get_relational_id()
@@ -4,11 +4,20 @@ To use, call get_connection() and save in a variable. This
 variable now holds a connection to the database hailtrace.
 See PyMongo documentation for example usage, i.e. db.insert_one()
 
+A single MongoClient, with its own connection pool, is shared by every
+caller in a process, so repeated calls do not open new connections. It
+is created lazily per process id, so a process forked from a pool gets
+a client of its own instead of the parent's sockets.
+
 NOTE: Make sure to setup .env file in processing folder for this
-to work, add connection string to variable MONGO_URI
+to work, add connection string to variable MONGO_URI. The pool can be
+tuned with MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE and the timeouts
+MONGO_SERVER_SELECTION_TIMEOUT_MS, MONGO_CONNECT_TIMEOUT_MS and
+MONGO_SOCKET_TIMEOUT_MS.
 """
 import logging
 import os
+import threading
 
 from dotenv import load_dotenv
 from pymongo import MongoClient
@@ -16,17 +25,58 @@ from pymongo.errors import ConnectionFailure
 
 load_dotenv()
 
+_OPTIONS = {
+    'maxPoolSize': ('MONGO_MAX_POOL_SIZE', 100),
+    'minPoolSize': ('MONGO_MIN_POOL_SIZE', 0),
+    'serverSelectionTimeoutMS': ('MONGO_SERVER_SELECTION_TIMEOUT_MS', 30000),
+    'connectTimeoutMS': ('MONGO_CONNECT_TIMEOUT_MS', 20000),
+    'socketTimeoutMS': ('MONGO_SOCKET_TIMEOUT_MS', None)
+}
+
+_clients = {}  # process id -> MongoClient
+_lock = threading.Lock()
+
+
+def client_options():
+    """Pool size and timeouts of the shared client, from the environment"""
+    options = {}
+    for option, (variable, default) in _OPTIONS.items():
+        value = os.getenv(variable)
+        options[option] = int(value) if value else default
+    return options
+
 
 def get_connection():
-    """Establish connection with database"""
-    try:
-        conn_str = os.getenv('MONGO_URI')
-        client = MongoClient(conn_str)
-    except ConnectionFailure as exception:
-        logging.error("Failure to connect to db. {}".format(exception))
-    else:
-        logging.info("Database connection was successful")
-    return client
+    """Shared client of this process, created on the first call.
+
+    The client only connects when it is first used, so it is safe to
+    create before forking, and is never closed by callers.
+    """
+    pid = os.getpid()
+    client = _clients.get(pid)
+    if client is not None:
+        return client
+    with _lock:
+        if pid not in _clients:
+            # Clients inherited from a parent process must not be used or closed here
+            _clients.clear()
+            try:
+                conn_str = os.getenv('MONGO_URI')
+                _clients[pid] = MongoClient(conn_str, connect=False, **client_options())
+            except ConnectionFailure as exception:
+                logging.error("Failure to connect to db. {}".format(exception))
+                raise
+            else:
+                logging.info("Database client created for process {}".format(pid))
+        return _clients[pid]
+
+
+def close_connection():
+    """Close this process's shared client, the next get_connection makes a new one"""
+    with _lock:
+        client = _clients.pop(os.getpid(), None)
+    if client is not None:
+        client.close()
 
 
 def insert_files(docs, collection):
@@ -38,12 +88,9 @@ def insert_files(docs, collection):
             raise ValueError("Param docs must be a list of json objects")
         if collection not in conn.hailtrace.list_collection_names():
             raise ValueError("Collection doesnt exist")
-        for doc in docs:
-            conn.hailtrace[collection].insert_one(doc)
+        if len(docs) > 0:
+            conn.hailtrace[collection].insert_many(docs)
     except ValueError as val_e:
         logging.error("{}".format(val_e))
     else:
         logging.info("Successfully inserted documents")
-    finally:
-        logging.info("Closing Connection")
-        conn.close()
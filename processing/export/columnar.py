@@ -0,0 +1,254 @@
+"""Compact columnar files of hail products.
+
+The contours only exist as GeoJSON documents in the algo_* collections,
+which makes bulk analytics and backfills read millions of documents. This
+module writes the same features to files instead, one column per field:
+the polygons as WKB (x = lon, y = lat whatever the product's vertex order),
+the value as float64, the collection time as int64 microseconds since
+the epoch (naive times taken as UTC) and the repeated strings (color,
+station, id) as uint16 codes in to a dictionary.
+
+A file is a sequence of self-contained blocks, each a short JSON header
+followed by the raw little-endian column buffers, so features of more
+scans can be appended to a file and the file is read with one pass.
+
+Benchmark against the GeoJSON path with:
+
+    python3 -m processing.export.columnar [FEATURES]
+"""
+import json
+import os
+import struct
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from processing.export.tiles import LON_LAT
+from processing.utils.contour import decode_ring
+
+MAGIC = b'HTCB'
+VERSION = 1
+COLUMNAR_DIR = os.getcwd() + '/processing/export/columnar/'
+PERIODS = ('scan', 'hour')
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_STRINGS = ('color', 'station', 'id')
+_WKB_POLYGON = struct.pack('<BII', 1, 3, 1)  # little endian, polygon, one ring
+
+
+def product_path(directory, algorithm, station, collectiontime, period='scan'):
+    """File a product is written to, one per scan of a station, or one per
+    hour for every station"""
+    if period not in PERIODS:
+        raise ValueError("period must be one of {}, got {}".format(PERIODS, period))
+    day = os.path.join(directory, algorithm, collectiontime.strftime('%Y%m%d'))
+    if period == 'hour':
+        return os.path.join(day, collectiontime.strftime('%H') + '.htc')
+    return os.path.join(day, '{}_{}.htc'.format(station, collectiontime.strftime('%H%M')))
+
+
+def write_features(path, features, algorithm):
+    """Append the GeoJSON features of a product to path as one block.
+
+    # Arguments:
+        path: str
+            file to append to, created along with its directory if needed
+        features: list
+            GeoJSON Feature dicts as built by GeoJSONConverter
+        algorithm: str
+            product of the features, which decides their vertex order
+
+    return number of bytes written
+    """
+    block = encode_block(features, algorithm)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'ab') as f:
+        f.write(block)
+    return len(block)
+
+
+def encode_block(features, algorithm):
+    """Columns of features as the bytes of a single block"""
+    lon_lat = algorithm in LON_LAT
+    rings = []
+    for feature in features:
+        geometry = feature['geometry']
+        if geometry.get('encoding') == 'delta':
+            ring = decode_ring(geometry['coordinates'], geometry['digits'])
+        else:
+            ring = np.asarray(geometry['coordinates'], dtype=np.float64).reshape(-1, 2)
+        rings.append(ring if lon_lat else ring[:, ::-1])
+
+    lengths = np.array([len(ring) for ring in rings], dtype=np.int64)
+    wkb = b''.join(_WKB_POLYGON + struct.pack('<I', len(ring)) + np.ascontiguousarray(ring, '<f8').tobytes()
+                   for ring in rings)
+    offsets = np.concatenate(([0], np.cumsum(9 + 4 + 16 * lengths))).astype('<i8')
+
+    columns = [
+        ('geometry_offsets', offsets),
+        ('geometry', np.frombuffer(wkb, dtype=np.uint8)),
+        ('value', np.array([feature['properties']['value'] for feature in features], dtype='<f8')),
+        ('collectiontime', np.array([_microseconds(feature['collectiontime']) for feature in features],
+                                    dtype='<i8'))
+    ]
+    dictionaries = {}
+    for name in _STRINGS:
+        values = [feature['properties'][name] if name in feature['properties'] else feature[name]
+                  for feature in features]
+        dictionaries[name], codes = np.unique(values, return_inverse=True) if values else ([], [])
+        dictionaries[name] = [str(value) for value in dictionaries[name]]
+        columns.append((name, np.asarray(codes, dtype='<u2')))
+
+    header = json.dumps({
+        'count': len(features),
+        'algorithm': algorithm,
+        'columns': [[name, column.dtype.str, column.nbytes] for name, column in columns],
+        'dictionaries': dictionaries
+    }, separators=(',', ':')).encode()
+    return MAGIC + struct.pack('<II', VERSION, len(header)) + header + \
+        b''.join(column.tobytes() for _, column in columns)
+
+
+def _microseconds(collectiontime):
+    """Microseconds since the epoch of a collection time, UTC if naive"""
+    if collectiontime.tzinfo is None:
+        collectiontime = collectiontime.replace(tzinfo=timezone.utc)
+    return (collectiontime - _EPOCH) // timedelta(microseconds=1)
+
+
+def read_columns(path):
+    """Read every block of a file.
+
+    return dict of column name to ndarray over all blocks, the string
+    columns decoded to object arrays and 'geometry' a list of WKB bytes
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    blocks = []
+    position = 0
+    while position < len(data):
+        if data[position:position + 4] != MAGIC:
+            raise ValueError("{} is not a columnar product file".format(path))
+        version, size = struct.unpack_from('<II', data, position + 4)
+        if version != VERSION:
+            raise ValueError("Unsupported columnar version {}".format(version))
+        position += 12
+        header = json.loads(data[position:position + size].decode())
+        position += size
+        block = {}
+        for name, dtype, nbytes in header['columns']:
+            block[name] = np.frombuffer(data, dtype=dtype, count=nbytes // np.dtype(dtype).itemsize, offset=position)
+            position += nbytes
+        offsets = block.pop('geometry_offsets')
+        wkb = block['geometry'].tobytes()
+        block['geometry'] = [wkb[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+        for name in _STRINGS:
+            block[name] = np.asarray(header['dictionaries'][name], dtype=object)[block[name]]
+        block['algorithm'] = np.full(header['count'], header['algorithm'], dtype=object)
+        blocks.append(block)
+
+    if len(blocks) == 0:
+        return {}
+    columns = {name: np.concatenate([block[name] for block in blocks]) for name in blocks[0] if name != 'geometry'}
+    columns['geometry'] = [wkb for block in blocks for wkb in block['geometry']]
+    return columns
+
+
+def ring_from_wkb(wkb):
+    """(n, 2) (lon, lat) vertices of a WKB polygon written by this module"""
+    count, = struct.unpack_from('<I', wkb, 9)
+    return np.frombuffer(wkb, dtype='<f8', count=2 * count, offset=13).reshape(count, 2)
+
+
+def to_features(columns):
+    """GeoJSON features back from read_columns, vertices in the order each
+    product's features are built in and collection times in UTC"""
+    features = []
+    for index, wkb in enumerate(columns.get('geometry', [])):
+        ring = ring_from_wkb(wkb)
+        if columns['algorithm'][index] not in LON_LAT:
+            ring = ring[:, ::-1]
+        features.append({
+            'type': 'Feature',
+            'station': columns['station'][index],
+            'collectiontime': _EPOCH + timedelta(microseconds=int(columns['collectiontime'][index])),
+            'geometry': {'type': 'Polygon', 'coordinates': ring.tolist()},
+            'properties': {
+                'color': columns['color'][index],
+                'id': columns['id'][index],
+                'value': float(columns['value'][index])
+            }
+        })
+    return features
+
+
+def benchmark(features, algorithm, directory, repeat=3):
+    """Time writing and reading features as a columnar file and as JSON
+    lines, the form they are sent to the db in.
+
+    return dict of format -> {'bytes', 'write_seconds', 'read_seconds'}
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {'columnar': os.path.join(directory, 'benchmark.htc'),
+             'geojson': os.path.join(directory, 'benchmark.jsonl')}
+
+    def _write_geojson(path):
+        with open(path, 'w') as f:
+            for feature in features:
+                f.write(json.dumps(feature, default=str, separators=(',', ':')) + '\n')
+
+    def _read_geojson(path):
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def _write_columnar(path):
+        write_features(path, features, algorithm)
+
+    writers = {'columnar': _write_columnar, 'geojson': _write_geojson}
+    readers = {'columnar': read_columns, 'geojson': _read_geojson}
+    results = {}
+    for name, path in paths.items():
+        write_seconds = read_seconds = float('inf')
+        for _ in range(repeat):
+            if os.path.isfile(path):
+                os.remove(path)
+            start = time.perf_counter()
+            writers[name](path)
+            write_seconds = min(write_seconds, time.perf_counter() - start)
+            start = time.perf_counter()
+            readers[name](path)
+            read_seconds = min(read_seconds, time.perf_counter() - start)
+        results[name] = {'bytes': os.path.getsize(path), 'write_seconds': write_seconds,
+                         'read_seconds': read_seconds}
+        os.remove(path)
+    return results
+
+
+def _synthetic_features(count):
+    """MESH like features of rings around random storm centres"""
+    rng = np.random.RandomState(0)
+    angles = np.linspace(0, 2 * np.pi, 60)
+    features = []
+    for index in range(count):
+        centre = rng.uniform((-100, 30), (-90, 40))
+        radius = rng.uniform(0.01, 0.2)
+        ring = np.column_stack((centre[0] + radius * np.cos(angles), centre[1] + radius * np.sin(angles)))
+        ring[-1] = ring[0]
+        features.append({
+            'type': 'Feature',
+            'station': 'KTLX',
+            'collectiontime': datetime(2020, 5, 1, 12),
+            'geometry': {'type': 'Polygon', 'coordinates': np.around(ring, 3).tolist()},
+            'properties': {'color': '#440154', 'id': 'SKTLXC050120201200', 'elevation': 0.5, 'sweep': 0,
+                           'value': float(index % 20)}
+        })
+    return features
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    results = benchmark(_synthetic_features(count), 'MESH', COLUMNAR_DIR)
+    for name, result in results.items():
+        print("{:<9} {:>12,} bytes  write {:.3f}s  read {:.3f}s".format(
+            name, result['bytes'], result['write_seconds'], result['read_seconds']))
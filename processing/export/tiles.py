@@ -0,0 +1,312 @@
+"""Mapbox Vector Tiles of the hail products.
+
+Pulling every polygon of a product out of the algo_* collections gets
+slow once products cover the whole country, so the contours are also cut
+in to pre-generated vector tiles for a range of zoom levels and kept in an
+MBTiles file (SQLite) the map can serve tiles from directly.
+
+Each zoom level projects the rings to Web Mercator tile units, simplifies
+them to a fraction of a pixel at that zoom and clips them to every tile
+they cross. The clipped features are kept per layer (algorithm) and
+source (station) next to the encoded tiles, so a new scan only replaces
+its own station's features and re-encodes the tiles it, or the scan it
+replaces, touched.
+
+The protobuf of a tile is written here, following version 2.1 of the
+vector tile specification, to keep the dependencies as they are.
+"""
+import gzip
+import json
+import math
+import sqlite3
+import struct
+
+import numpy as np
+from shapely.geometry import Polygon, box
+
+from processing.utils.contour import decode_ring
+
+EXTENT = 4096  # tile units along each side of a tile
+BUFFER = 64  # tile units kept beyond each side so neighbouring polygons join
+MIN_ZOOM = 3
+MAX_ZOOM = 10
+SIMPLIFY_UNITS = 4.  # tile units, a quarter pixel of a 256 px tile
+LON_LAT = ('MESH', 'MESH_SWATH')  # layers whose vertices are (lon, lat), the rest are (lat, lon)
+PROPERTIES = ('value', 'color')
+_MAX_LAT = 85.0511287798  # edge of the Web Mercator square
+
+# Geometry commands and protobuf wire types
+_MOVE_TO, _LINE_TO, _CLOSE_PATH = 1, 2, 7
+_POLYGON = 3
+_VARINT, _LENGTH = 0, 2
+_DOUBLE = 1
+
+
+class TileCache:
+    """Vector tiles of hail features in an MBTiles file
+
+    # Arguments:
+        path: str
+            MBTiles file, created if needed
+        min_zoom, max_zoom: int
+            zoom levels tiles are generated for
+        lon_lat: sequence
+            layers whose feature vertices are (lon, lat) rather than (lat, lon)
+    """
+
+    def __init__(self, path, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM, lon_lat=LON_LAT):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.lon_lat = lon_lat
+        self._db = sqlite3.connect(path)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+                                              tile_data BLOB);
+            CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);
+            CREATE TABLE IF NOT EXISTS tile_features (zoom_level INTEGER, tile_column INTEGER,
+                                                      tile_row INTEGER, layer TEXT, source TEXT,
+                                                      features TEXT);
+            CREATE INDEX IF NOT EXISTS tile_features_tile ON tile_features (zoom_level, tile_column, tile_row);
+            CREATE INDEX IF NOT EXISTS tile_features_source ON tile_features (layer, source);
+        ''')
+        self._db.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)', [
+            ('name', 'hailtrace'), ('format', 'pbf'), ('type', 'overlay'), ('version', '1'),
+            ('minzoom', str(min_zoom)), ('maxzoom', str(max_zoom))])
+        self._db.commit()
+
+    def update(self, layer, source, features):
+        """Replace the features of source in layer and re-encode the tiles
+        either set of features touches.
+
+        # Arguments:
+            layer: str
+                algorithm of the features, i.e. 'MESH'
+            source: str
+                station the features came from
+            features: iterable
+                GeoJSON Feature dicts as built by GeoJSONConverter, an
+                empty iterable clears the source
+
+        return number of tiles written or removed
+        """
+        update = self.updater(layer, source)
+        update.add(features)
+        return update.commit()
+
+    def updater(self, layer, source):
+        """return TileUpdate to add the features of layer from source in
+        batches, committed together"""
+        return TileUpdate(self, layer, source)
+
+    def tile(self, zoom, x, y):
+        """return the gzipped tile at zoom, x, y (XYZ scheme) or None"""
+        row = self._db.execute('SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                               (zoom, x, _tms_row(zoom, y))).fetchone()
+        return None if row is None else row[0]
+
+    def close(self):
+        self._db.close()
+
+    def _replace(self, layer, source, tiles):
+        """Swap the stored features of source for tiles, a dict of
+        (zoom, x, y) -> list of features, and re-encode the tiles"""
+        touched = set(self._db.execute(
+            'SELECT zoom_level, tile_column, tile_row FROM tile_features WHERE layer=? AND source=?',
+            (layer, source)).fetchall())
+        rows = [(zoom, x, _tms_row(zoom, y), layer, source, json.dumps(features, separators=(',', ':')))
+                for (zoom, x, y), features in tiles.items()]
+        touched.update(row[:3] for row in rows)
+        with self._db:
+            self._db.execute('DELETE FROM tile_features WHERE layer=? AND source=?', (layer, source))
+            self._db.executemany('INSERT INTO tile_features VALUES (?, ?, ?, ?, ?, ?)', rows)
+            for zoom, x, tms_row in touched:
+                self._encode(zoom, x, tms_row)
+        return len(touched)
+
+    def _encode(self, zoom, x, tms_row):
+        """Write the tile from every feature stored for it, or remove it
+        when there are none left"""
+        layers = {}
+        for layer, features in self._db.execute(
+                'SELECT layer, features FROM tile_features WHERE zoom_level=? AND tile_column=? AND tile_row=? '
+                'ORDER BY layer, source', (zoom, x, tms_row)):
+            layers.setdefault(layer, []).extend(json.loads(features))
+        if len(layers) == 0:
+            self._db.execute('DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                             (zoom, x, tms_row))
+            return
+        data = gzip.compress(encode_tile(layers))
+        self._db.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)', (zoom, x, tms_row, sqlite3.Binary(data)))
+
+
+class TileUpdate:
+    """Features of a single layer and source cut in to tiles as they are
+    added, see TileCache.updater. Only the clipped tile geometry is kept,
+    so features can be added batch by batch while they are uploaded."""
+
+    def __init__(self, cache, layer, source):
+        self._cache = cache
+        self._layer = layer
+        self._source = source
+        self._tiles = {}
+
+    def add(self, features):
+        lon_lat = self._layer in self._cache.lon_lat
+        for feature in features:
+            geometry = feature['geometry']
+            ring = np.asarray(geometry['coordinates'], dtype=np.float64)
+            if geometry.get('encoding') == 'delta':
+                ring = decode_ring(ring, geometry['digits'])
+            if len(ring) < 4:
+                continue
+            if not lon_lat:
+                ring = ring[:, ::-1]
+            properties = {key: feature['properties'][key] for key in PROPERTIES if key in feature['properties']}
+            for zoom in range(self._cache.min_zoom, self._cache.max_zoom + 1):
+                for tile, rings in clip_ring(ring, zoom):
+                    self._tiles.setdefault((zoom,) + tile, []).append([properties, rings])
+
+    def commit(self):
+        """Store the features added and re-encode the touched tiles,
+        return number of tiles written or removed"""
+        return self._cache._replace(self._layer, self._source, self._tiles)
+
+
+def mercator(lons, lats):
+    """Web Mercator position of lon, lat (deg) as fractions of the world,
+    x from the antimeridian eastwards and y from the north edge south"""
+    lats = np.radians(np.clip(lats, -_MAX_LAT, _MAX_LAT))
+    x = (np.asarray(lons, dtype=np.float64) + 180.) / 360.
+    y = (1. - np.arcsinh(np.tan(lats)) / math.pi) / 2.
+    return x, y
+
+
+def clip_ring(ring, zoom):
+    """Cut a closed (lon, lat) ring in to the tiles it crosses at zoom.
+
+    The ring is simplified to SIMPLIFY_UNITS in tile units first, so lower
+    zooms keep fewer vertices.
+
+    return list of ((x, y), rings) per tile, rings being the polygon's
+    exterior then interior rings as lists of integer tile unit vertices
+    """
+    x, y = mercator(ring[:, 0], ring[:, 1])
+    scale = EXTENT * 2 ** zoom
+    polygon = Polygon(np.column_stack((x * scale, y * scale)))
+    if not polygon.is_valid:
+        polygon = polygon.buffer(0)
+    polygon = polygon.simplify(SIMPLIFY_UNITS, preserve_topology=True)
+    if polygon.is_empty or polygon.area < 1:
+        return []
+    min_x, min_y, max_x, max_y = polygon.bounds
+    last = 2 ** zoom - 1
+    clipped = []
+    for tile_x in range(max(int((min_x - BUFFER) // EXTENT), 0), min(int((max_x + BUFFER) // EXTENT), last) + 1):
+        for tile_y in range(max(int((min_y - BUFFER) // EXTENT), 0), min(int((max_y + BUFFER) // EXTENT), last) + 1):
+            left, top = tile_x * EXTENT, tile_y * EXTENT
+            part = polygon.intersection(box(left - BUFFER, top - BUFFER, left + EXTENT + BUFFER, top + EXTENT + BUFFER))
+            for piece in getattr(part, 'geoms', [part]):
+                if piece.geom_type != 'Polygon' or piece.is_empty:
+                    continue
+                exterior = _tile_ring(piece.exterior.coords, left, top, True)
+                if exterior is None:
+                    continue
+                interiors = [_tile_ring(interior.coords, left, top, False) for interior in piece.interiors]
+                clipped.append(((tile_x, tile_y), [exterior] + [ring for ring in interiors if ring is not None]))
+    return clipped
+
+
+def _tile_ring(coords, left, top, exterior):
+    """Integer vertices of a ring relative to the tile's corner, without
+    the closing vertex, wound as the specification asks (exterior rings
+    clockwise on screen, interior anticlockwise). None if it collapses."""
+    points = np.rint(np.asarray(coords)[:-1] - (left, top)).astype(np.int64)
+    keep = np.any(points != np.roll(points, 1, axis=0), axis=1)
+    points = points[keep]
+    if len(points) < 3:
+        return None
+    area = np.dot(points[:, 0], np.roll(points[:, 1], -1)) - np.dot(np.roll(points[:, 0], -1), points[:, 1])
+    if area == 0:
+        return None
+    if (area > 0) != exterior:
+        points = points[::-1]
+    return points.tolist()
+
+
+def encode_tile(layers):
+    """Vector tile protobuf of layers, a dict of layer name -> list of
+    [properties, rings] features"""
+    tile = bytearray()
+    for name, features in layers.items():
+        tile += _field(3, _LENGTH, _encode_layer(name, features))
+    return bytes(tile)
+
+
+def _encode_layer(name, features):
+    keys, values = {}, {}
+    layer = bytearray(_field(15, _VARINT, 2) + _field(1, _LENGTH, name.encode()))
+    for properties, rings in features:
+        tags = []
+        for key, value in properties.items():
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value).__name__, value), len(values)))
+        feature = _field(2, _LENGTH, _packed(tags)) + _field(3, _VARINT, _POLYGON) + \
+            _field(4, _LENGTH, _packed(_geometry(rings)))
+        layer += _field(2, _LENGTH, feature)
+    for key in keys:
+        layer += _field(3, _LENGTH, key.encode())
+    for (kind, value) in values:
+        if kind == 'str':
+            layer += _field(4, _LENGTH, _field(1, _LENGTH, value.encode()))
+        else:
+            layer += _field(4, _LENGTH, _field(3, _DOUBLE, float(value)))
+    layer += _field(5, _VARINT, EXTENT)
+    return bytes(layer)
+
+
+def _geometry(rings):
+    """Command integers of a polygon, every vertex a zigzag delta of the one before"""
+    commands = []
+    cursor_x = cursor_y = 0
+    for ring in rings:
+        for index, (x, y) in enumerate(ring):
+            if index == 0:
+                commands.append(_MOVE_TO | (1 << 3))
+            elif index == 1:
+                commands.append(_LINE_TO | ((len(ring) - 1) << 3))
+            commands += [_zigzag(x - cursor_x), _zigzag(y - cursor_y)]
+            cursor_x, cursor_y = x, y
+        commands.append(_CLOSE_PATH | (1 << 3))
+    return commands
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _packed(values):
+    return b''.join(_varint(value) for value in values)
+
+
+def _field(number, wire_type, value):
+    key = _varint((number << 3) | wire_type)
+    if wire_type == _VARINT:
+        return key + _varint(value)
+    if wire_type == _DOUBLE:
+        return key + struct.pack('<d', value)
+    return key + _varint(len(value)) + bytes(value)
+
+
+def _tms_row(zoom, y):
+    """MBTiles rows count from the south"""
+    return 2 ** zoom - 1 - y
@@ -0,0 +1,296 @@
+"""Figure free filled contouring.
+
+pyplot.contourf goes through global pyplot state and leaves a figure
+behind for every product, which leaks memory in the scheduler and is not
+safe to call from threads. This module calls the contour generator that
+contourf is built on directly, contourpy when it is installed and
+otherwise the matplotlib._contour module it was split out of, and only
+keeps the polygon rings. Nothing is shared between calls, so products can
+be contoured concurrently.
+
+Contouring can also run in (row, column) index space of the data, in
+which case only the vertices of the resulting rings are mapped to the
+data's coordinates, which is far fewer points than the data itself.
+"""
+import numpy as np
+from matplotlib import cm, rcParams
+from matplotlib.colors import Colormap, rgb2hex
+from scipy.ndimage import map_coordinates
+from shapely.geometry import LinearRing, LineString
+
+try:
+    import contourpy
+except ImportError:  # matplotlib < 3.6 ships the generator itself
+    contourpy = None
+    from matplotlib import _contour
+
+try:
+    from matplotlib import colormaps
+except ImportError:  # matplotlib < 3.5, cm.get_cmap is removed from 3.9
+    colormaps = None
+
+_MOVETO = 1
+_CLOSEPOLY = 79
+_METRES_PER_DEGREE = 111320.
+_VERTEX_SCALE = 1e9  # vertices are matched to 1e-9 degrees
+
+
+def filled_contours(x, y, z, levels, corner_mask=True, index_space=False, origin=(0, 0), zmin=None):
+    """Filled contours of z between consecutive levels, every band at once.
+    See iter_filled_contours for the arguments.
+
+    return list of (lower, upper, rings) per band
+    """
+    return list(iter_filled_contours(x, y, z, levels, corner_mask, index_space, origin, zmin))
+
+
+def iter_filled_contours(x, y, z, levels, corner_mask=True, index_space=False, origin=(0, 0), zmin=None):
+    """Filled contours of z between consecutive levels, one band at a time.
+
+    The generator is set up and the levels checked straight away, but each
+    band is only contoured when it is asked for, so the rings of a band can
+    be used and dropped before the next one is found.
+
+    Bands are the same as contourf(x, y, z, levels=levels): values in
+    (lower, upper], with the lowest band also holding z values equal to
+    the first level.
+
+    # Arguments:
+        x, y: ndarray
+            2-D coordinates of z, vertices are returned as (x, y)
+        z: ndarray
+            2-D values, masked points are left out of every band
+        levels: sequence
+            increasing band edges
+        index_space: bool
+            contour on the column and row indices of z and map only the
+            vertices to x, y by bilinear interpolation, see to_coordinates
+        origin: tuple
+            (row, column) of z[0, 0] in x and y when z is a window of
+            the data and index_space is set
+        zmin: float
+            minimum of the whole field when z is a window of it, decides
+            whether the lowest band holds values equal to the first level
+
+    return iterator of (lower, upper, rings) per band, rings being a list
+    of closed (n, 2) vertex arrays (outer boundaries and holes alike)
+    """
+    levels = np.asarray(levels, dtype=np.float64)
+    if levels.ndim != 1 or len(levels) < 2 or np.any(np.diff(levels) <= 0):
+        raise ValueError("Contour levels must be increasing")
+    z = np.ma.masked_invalid(z).astype(np.float64)
+    mask = np.ma.getmask(z)
+    if mask is np.ma.nomask or not mask.any():
+        mask = None
+    if index_space:
+        grid_x, grid_y = _index_grid(z.shape)
+    else:
+        grid_x = np.asarray(x, dtype=np.float64)
+        grid_y = np.asarray(y, dtype=np.float64)
+
+    if contourpy is not None:
+        generator = contourpy.contour_generator(
+            grid_x, grid_y, np.ma.masked_array(z.filled(), mask=mask), name='mpl2014',
+            corner_mask=corner_mask, fill_type=contourpy.FillType.OuterCode)
+    else:
+        generator = _contour.QuadContourGenerator(grid_x, grid_y, z.filled(), mask, corner_mask, 0)
+
+    lowers = levels[:-1].copy()
+    if (z.min() if zmin is None else zmin) == lowers[0]:
+        # Include minimum values in lowest interval, as contourf does
+        lowers[0] -= 1
+    return _bands(generator, levels, lowers, index_space, origin, x, y)
+
+
+def _bands(generator, levels, lowers, index_space, origin, x, y):
+    """Contour one band at a time, see iter_filled_contours"""
+    for lower, upper, band_lower in zip(levels[:-1], levels[1:], lowers):
+        if contourpy is not None:
+            vertices, codes = generator.filled(band_lower, upper)
+        else:
+            vertices, codes = generator.create_filled_contour(band_lower, upper)
+        rings = []
+        for path_vertices, path_codes in zip(vertices, codes):
+            rings.extend(_split_rings(path_vertices, path_codes))
+        if index_space:
+            rings = to_coordinates([ring + (origin[1], origin[0]) for ring in rings], x, y)
+        yield lower, upper, rings
+
+
+def _index_grid(shape):
+    """2-D (column, row) index coordinates for the generator"""
+    rows, cols = np.indices(shape, dtype=np.float64)
+    return cols, rows
+
+
+def to_coordinates(rings, x, y):
+    """Map rings of (column, row) index vertices to x, y.
+
+    Vertices lie on the edges between grid points, where bilinear
+    interpolation of the coordinates is exact for a contour found on the
+    coordinates themselves. All rings are mapped in a single call.
+
+    return list of (n, 2) (x, y) vertex arrays
+    """
+    if len(rings) == 0:
+        return rings
+    vertices = np.concatenate(rings)
+    points = [vertices[:, 1], vertices[:, 0]]
+    mapped = np.column_stack((
+        map_coordinates(np.asarray(x, dtype=np.float64), points, order=1, mode='nearest'),
+        map_coordinates(np.asarray(y, dtype=np.float64), points, order=1, mode='nearest')))
+    return np.split(mapped, np.cumsum([len(ring) for ring in rings[:-1]]))
+
+
+def _split_rings(vertices, codes):
+    """Split a path in to closed rings at each MOVETO"""
+    starts = np.flatnonzero(codes == _MOVETO)
+    rings = []
+    for start, stop in zip(starts, np.append(starts[1:], len(codes))):
+        ring = vertices[start:stop][codes[start:stop] != _CLOSEPOLY]
+        if len(ring) < 3:
+            continue
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.concatenate((ring, ring[:1]))
+        rings.append(ring)
+    return rings
+
+
+def level_colors(levels, cmap=None):
+    """Hex colors contourf would give each band between levels, the
+    midpoint of a band on the colormap scaled to the outer levels"""
+    levels = np.asarray(levels, dtype=np.float64)
+    if not isinstance(cmap, Colormap):
+        name = cmap if cmap is not None else rcParams['image.cmap']
+        cmap = colormaps[name] if colormaps is not None else cm.get_cmap(name)
+    middles = (levels[:-1] + levels[1:]) / 2
+    span = levels[-1] - levels[0]
+    return [rgb2hex(cmap((middle - levels[0]) / span)) for middle in middles]
+
+
+def simplify_coverage(bands, tolerance):
+    """Douglas-Peucker simplify the rings of every band of a product at once,
+    keeping the edges shared by neighbouring bands (and by a band's holes
+    and the shells inside them) identical.
+
+    Rings are cut in to arcs at every vertex where rings part ways, i.e. a
+    vertex with more than two distinct neighbours over all the rings, and
+    each arc is simplified once with its ends fixed, so the rings on both
+    sides of an edge keep the same vertices and no slivers or overlaps open
+    between them. An arc that leaves a ring self intersecting is kept as it
+    was in every ring that has it.
+
+    The tolerance is converted to degrees of latitude, so along a
+    longitude axis the largest shift is never more than tolerance either.
+    Rings collapsing to fewer than 4 points are dropped.
+
+    # Arguments:
+        bands: list
+            list of closed (n, 2) vertex arrays in degrees per band
+        tolerance: float
+            largest distance (m) a vertex may move
+
+    return list of simplified rings per band
+    """
+    degrees = tolerance / _METRES_PER_DEGREE
+    rings = [(band, ring[:-1]) for band, band_rings in enumerate(bands) for ring in band_rings if len(ring) >= 4]
+    if len(rings) == 0:
+        return [[] for _ in bands]
+
+    # Vertices equal to the last bits of the contour generator are the same vertex
+    vertices, ids = np.unique(np.rint(np.concatenate([ring for _, ring in rings]) * _VERTEX_SCALE),
+                              axis=0, return_inverse=True)
+    ids = np.split(ids.ravel(), np.cumsum([len(ring) for _, ring in rings[:-1]]))
+    vertices = vertices / _VERTEX_SCALE
+    pairs = np.concatenate([np.column_stack((ring_ids, np.roll(ring_ids, shift)))
+                            for ring_ids in ids for shift in (1, -1)])
+    junction = np.bincount(np.unique(pairs, axis=0)[:, 0], minlength=len(vertices)) > 2
+
+    arcs = [_ring_arcs(ring_ids, junction) for ring_ids in ids]
+    simplified = {}
+    kept = set()
+    while True:
+        result = [[] for _ in bands]
+        broken = set()
+        for (band, _), ring_arcs in zip(rings, arcs):
+            pieces = []
+            for key, arc, reverse in ring_arcs:
+                if key in kept:
+                    coords = vertices[arc]
+                else:
+                    if key not in simplified:
+                        simplified[key] = _simplify_arc(vertices[arc], degrees)
+                    coords = simplified[key]
+                pieces.append((coords[::-1] if reverse else coords)[:-1])
+            ring = np.concatenate(pieces)
+            if len(ring) < 3:
+                continue
+            ring = np.concatenate((ring, ring[:1]))
+            changed = [key for key, _, _ in ring_arcs if key not in kept]
+            if changed and not LinearRing(ring).is_simple:
+                broken.update(changed)
+                continue
+            result[band].append(ring)
+        if not broken:
+            return result
+        kept |= broken
+
+
+def _ring_arcs(ring_ids, junction):
+    """Cut an open ring of vertex ids in to arcs between junctions.
+
+    Each arc is given in one canonical direction whichever ring it is
+    found in, so it is simplified the same way for every ring.
+
+    return list of (key, vertex ids, reversed) in ring order
+    """
+    cuts = np.flatnonzero(junction[ring_ids])
+    if len(cuts) == 0:
+        # A ring sharing all or none of its edges, start it at its lowest vertex
+        start = np.argmin(ring_ids)
+        ring_ids = np.roll(ring_ids, -start)
+        cuts = np.array([0])
+    else:
+        ring_ids = np.roll(ring_ids, -cuts[0])
+        cuts = cuts - cuts[0]
+    ring_ids = np.append(ring_ids, ring_ids[0])
+    arcs = []
+    for first, last in zip(cuts, np.append(cuts[1:], len(ring_ids) - 1)):
+        arc = ring_ids[first:last + 1]
+        reverse = (arc[-1], arc[-2]) < (arc[0], arc[1])
+        if reverse:
+            arc = arc[::-1]
+        arcs.append(((arc[0], arc[1], arc[-1]), arc, reverse))
+    return arcs
+
+
+def _simplify_arc(coords, degrees):
+    """Douglas-Peucker simplify a line, keeping both ends"""
+    if len(coords) <= 2:
+        return coords
+    return np.asarray(LineString(coords).simplify(degrees, preserve_topology=False).coords)
+
+
+def quantize_rings(rings, digits=3):
+    """Integer, delta encode rings.
+
+    Every vertex is scaled by 10 ** digits and rounded, then all but the
+    first vertex of a ring are stored as the difference from the vertex
+    before, which keeps most values to a few digits.
+
+    return list of (n, 2) int64 arrays, see decode_ring
+    """
+    if len(rings) == 0:
+        return rings
+    lengths = [len(ring) for ring in rings]
+    ints = np.rint(np.concatenate(rings) * 10 ** digits).astype(np.int64)
+    deltas = ints.copy()
+    deltas[1:] -= ints[:-1]
+    starts = np.cumsum([0] + lengths[:-1])
+    deltas[starts] = ints[starts]
+    return np.split(deltas, starts[1:])
+
+
+def decode_ring(coordinates, digits=3):
+    """Inverse of quantize_rings for a single ring, return (n, 2) floats"""
+    return np.cumsum(np.asarray(coordinates, dtype=np.int64), axis=0) / 10 ** digits
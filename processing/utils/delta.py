@@ -0,0 +1,98 @@
+"""Delta storage of consecutive scans' contours.
+
+Scans of a station 4-5 minutes apart often contour to the same polygons
+on several levels. In delta mode each level's features are hashed, and a
+level with the same hash as the station's last scan is not inserted
+again but stored as a reference doc pointing at the scan holding its
+features. reconstruct puts a scan's features back together.
+
+References always point at the scan the features were inserted with, so
+a level unchanged over many scans is never more than one lookup away.
+"""
+import hashlib
+import json
+
+REFS_SUFFIX = '_refs'  # collection of reference docs next to each algo collection
+
+
+def level_hashes(features):
+    """return dict of contour level value -> sha1 of the geometry and color
+    of the level's features, in the order they were built"""
+    digests = {}
+    for feature in features:
+        value = feature['properties']['value']
+        if value not in digests:
+            digests[value] = hashlib.sha1()
+        digests[value].update(json.dumps([feature['geometry'], feature['properties']['color']],
+                                         separators=(',', ':')).encode())
+    return {value: digest.hexdigest() for value, digest in digests.items()}
+
+
+class DeltaEncoder:
+    """Last scan's level hashes per product and station"""
+
+    def __init__(self):
+        self._last = {}  # (algorithm, station) -> {value: (hash, id of scan holding the features, count)}
+
+    def encode(self, features, metadata, relational_id):
+        """Split a scan's features in to those to insert and references.
+
+        # Arguments:
+            features: list
+                GeoJSON Feature dicts of one scan
+            metadata: dict
+                GeoJSONConverter.get_metadata() of the scan
+            relational_id: dict
+                GeoJSONConverter.get_relational_id() of the scan
+
+        return (features of changed levels, list of reference docs)
+        """
+        key = (metadata['algorithm'], metadata['station'])
+        last = self._last.get(key, {})
+        current = {}
+        unchanged = set()
+        references = []
+        counts = {}
+        for feature in features:
+            value = feature['properties']['value']
+            counts[value] = counts.get(value, 0) + 1
+        for value, digest in level_hashes(features).items():
+            if value in last and last[value][0] == digest:
+                current[value] = last[value]
+                unchanged.add(value)
+                references.append({
+                    'id': relational_id['id'],
+                    'station': metadata['station'],
+                    'collectiontime': metadata['collectiontime'],
+                    'value': value,
+                    'ref': last[value][1],
+                    'hash': digest,
+                    'featurecount': counts[value]
+                })
+            else:
+                current[value] = (digest, relational_id['id'], counts[value])
+        self._last[key] = current
+        changed = [feature for feature in features if feature['properties']['value'] not in unchanged]
+        return changed, references
+
+
+def reconstruct(database, algo_collection, relational_id):
+    """Every feature of a scan stored in delta mode.
+
+    # Arguments:
+        database: Database
+            pymongo database, i.e. db.get_connection().hailtrace
+        algo_collection: str
+            collection the features were inserted in to, i.e. 'algo_mehs'
+        relational_id: str
+            id of the scan, GeoJSONConverter.get_id()
+
+    return list of feature docs, referenced levels carrying the id of the
+    scan they were inserted with
+    """
+    features = list(database[algo_collection].find({'properties.id': relational_id}))
+    for reference in database[algo_collection + REFS_SUFFIX].find({'id': relational_id}):
+        features.extend(database[algo_collection].find(
+            {'properties.id': reference['ref'], 'properties.value': reference['value']}))
+    features.sort(key=lambda feature: feature['properties']['value'])
+    return features
@@ -8,30 +8,47 @@ surface mesh of those points, applying the correct color to each cell of the
 surface mesh based on the field value at that given point, and then finally
 putting the spatial information of the cells and the colors in a GeoJSON
 FeatureCollection.
+
+With stream set, nothing is contoured until the features are iterated
+with iter_features or iter_batches, and each contour level is found and
+turned in to features only as the one before it has been consumed.
 """
+import json
 import logging
-import queue
-import threading
+import sys
+import time
+from itertools import islice
 
-import matplotlib.pyplot as plt
 import numpy as np
 
-from geojson import Polygon, Feature
-from matplotlib.colors import rgb2hex
+from scipy import ndimage
 from scipy.ndimage.filters import gaussian_filter
 
+from processing.utils.contour import iter_filled_contours, level_colors, quantize_rings, simplify_coverage
+
 
 class GeoJSONConverter:
     """Class to help convert from radar object with hail size
     information to geojson object which can be plotted on the maps in
     the user interface
     """
-    _NUM_THREADS = 15
+    _DIGITS = 3  # decimals kept of each coordinate
+    _FILL = 9999  # value of masked points
+    _SIGMA = 2  # smoothing applied before contouring
 
-    def __init__(self, data, lats, lons, algorithm, station, date, levels=None):
+    def __init__(self, data, lats, lons, algorithm, station, date, levels=None, index_space=False,
+                 simplify=None, quantize=False, stream=False):
         self._data = data
         self._lats = lats
         self._lons = lons
+        """Contour on array indices and only transform the vertices to lats, lons"""
+        self._index_space = index_space
+        """Tolerance (m) to simplify polygons to, and whether to store coordinates
+        as delta encoded integers (see processing.utils.contour.decode_ring)"""
+        self._simplify = simplify
+        self._quantize = quantize
+        """Build features lazily while they are iterated instead of in the constructor"""
+        self._stream = stream
 
         """Check dimensions of data so the contours line up"""
         if self._lats.shape[0] != self._data.shape[0]:
@@ -43,8 +60,11 @@ class GeoJSONConverter:
             self._contour_levels = []
 
         self._features = []
+        self._windows = []
+        self._zmin = None
         self._contours = None
         self._data_mappings = {}
+        self._build_stats = None
 
         """Initialize metadata"""
         self._date = date
@@ -61,6 +81,8 @@ class GeoJSONConverter:
 
         if self._contour_levels[0] == self._contour_levels[-1]:
             self._features = [-1]
+        elif self._stream:
+            self._contours = self._iter_contours()
         else:
             self._find_contours()
             self._gen_feature_collection()
@@ -69,56 +91,100 @@ class GeoJSONConverter:
     def _pre_process(self):
         """Prepare the hail and spatial data for contouring.
 
-        Converts data in to np.array filling in the masked fields,
+        Converts data in to a float32 np.array filling in the masked fields,
         and apply a gaussian filter to reduce the radar noise. Splits
         the range of the data in to 20 bins which mark where the contour
         lines will be, in terms of the data value being split.
+
+        Only the windows of the data which can end up inside a contour are
+        smoothed, see _find_windows.
         """
         if len(self._contour_levels) == 0:
             self._contour_levels = np.linspace(self._data.min(), self._data.max(), 5)
-        self._data = np.ma.filled(self._data, 9999)
-        self._data = gaussian_filter(self._data, sigma=2)
+        self._data = np.ma.filled(np.ma.asarray(self._data, dtype=np.float32), self._FILL)
+        self._find_windows()
+
+    def _find_windows(self):
+        """Smooth only the regions of the data which can hold contours.
+
+        A smoothed point can only fall between the outer contour levels if
+        the filter's window around it holds a value between them, or values
+        both below and above them. Those points, grown by one so contours
+        close around them, are split in to connected regions. Each region's
+        bounding box is smoothed with the filter radius of data around it,
+        which gives the same values as smoothing the whole field. Points of
+        other regions inside a box are masked so they are only contoured
+        once. Everything outside the regions stays outside every band.
+        """
+        levels = np.asarray(self._contour_levels, dtype=np.float64)
+        radius = int(4.0 * self._SIGMA + 0.5)  # gaussian_filter's default truncate of 4
+
+        def _near(points):
+            return ndimage.maximum_filter(points.view(np.uint8), size=2 * radius + 1, mode='reflect') > 0
+
+        below = self._data < levels[0]
+        above = self._data > levels[-1]
+        near_below = _near(below)
+        near_above = _near(above)
+        near_between = _near(~below & ~above)
+        candidates = near_between | (near_below & near_above)
+        # Points with nothing but low values near them are below the lowest level once smoothed
+        only_below = near_below & ~near_above & ~near_between
+
+        square = np.ones((3, 3), dtype=bool)
+        labels, _ = ndimage.label(ndimage.binary_dilation(candidates, structure=square), structure=square)
+        nrows, ncols = self._data.shape
+        mins = []
+        for label, (rows, cols) in enumerate(ndimage.find_objects(labels), start=1):
+            padded = (slice(max(rows.start - radius, 0), min(rows.stop + radius, nrows)),
+                      slice(max(cols.start - radius, 0), min(cols.stop + radius, ncols)))
+            smoothed = gaussian_filter(self._data[padded], sigma=self._SIGMA)
+            inner = smoothed[rows.start - padded[0].start:rows.stop - padded[0].start,
+                             cols.start - padded[1].start:cols.stop - padded[1].start]
+            window_labels = labels[rows, cols]
+            inner = np.ma.masked_where((window_labels != 0) & (window_labels != label), inner)
+            mins.append(inner.min())
+            self._windows.append(((rows, cols), inner))
+        self._zmin = -np.inf if only_below.any() or len(mins) == 0 else min(mins)
 
     def _find_contours(self):
         """Find contours given the hail and spatial data.
 
-        Works by making a surface mesh using Delaunay triangulation and
-        assigning fill value at each cell corresponding to field value,
-        which results in visible contours of values divided in to n regions.
+        Works by running the contour generator behind contourf directly on
+        each smoothed window of the data, without a figure, so the field is
+        divided in to n regions of polygon rings each with the color
+        contourf would give it.
         """
         try:
-            """Find contours using the datapoints and grid surface"""
-            self._contours = plt.contourf(
-                self._lats, self._lons, self._data,
-                levels=self._contour_levels,
-                vmin=min(self._contour_levels), vmax=max(self._contour_levels)
-            )
-            """Assign contour value to each color for legend in ui"""
-            colors = [collection.get_facecolor() for collection in self._contours.collections]
-            for color_idx in enumerate(colors):
-                color = color_idx[1][0]
-                if not isinstance(color, str):
-                    color = rgb2hex(color)
-                self._data_mappings[color] = self._contour_levels[color_idx[0]]
+            self._contours = list(self._iter_contours())
         except Exception as e:
             """Set features to -1 as a flag that contours where not
             able to be found"""
             logging.warning("No contours found in data")
+            self._contours = None
             self._features = [-1]
 
-    def _init_featureproc_threads(self):
-        threads = []
-        running = threading.Event()
-        to_proc = queue.Queue()
-        running.set()
-        for i in range(1, self._NUM_THREADS):
-            thread = threading.Thread(
-                target=self._proc_feature,
-                args=(to_proc, running)
-            )
-            thread.start()
-            threads.append(thread)
-        return threads, running, to_proc
+    def _iter_contours(self):
+        """Yield (rings, color) of each contour level in turn, advancing
+        the contour generator of every window by one band at a time"""
+        windows = []
+        for (rows, cols), window in self._windows:
+            if self._index_space:
+                windows.append(iter_filled_contours(
+                    self._lats, self._lons, window, self._contour_levels,
+                    index_space=True, origin=(rows.start, cols.start), zmin=self._zmin))
+            else:
+                windows.append(iter_filled_contours(
+                    self._lats[rows, cols], self._lons[rows, cols], window, self._contour_levels,
+                    zmin=self._zmin))
+        """Assign contour value to each color for legend in ui"""
+        colors = level_colors(self._contour_levels)
+        for lower, color in zip(self._contour_levels, colors):
+            self._data_mappings[color] = lower
+            rings = []
+            for bands in windows:
+                rings.extend(next(bands)[2])
+            yield rings, color
 
     def _gen_feature_collection(self):
         """Extract polygons from contours to generate feature collection.
@@ -126,52 +192,88 @@ class GeoJSONConverter:
         The feature collection will be split and inserted as individual
         GeoJSON docs for the db; however, it is easier to keep them together
         in a Feature Collection while being staged.
-        """
-        threads, running, jobs = self._init_featureproc_threads()
-        for collection in self._contours.collections:
-            color = collection.get_facecolor()
-            for path in collection.get_paths():
-                feature_data = (path, color)
-                jobs.put(feature_data)
-        running.clear()
-        for thread in threads:
-            thread.join()
-
-    def _proc_feature(self, to_proc, running):
-        """Add info fields to the feature (a hail contour)
 
+        The rings of each level are rounded together with one numpy call and
+        every feature is copied from that level's template as a plain dict.
         Each feature must have a 'id' field as this is the relational
         link between all the hail contours for a given station and time.
-        The other attributes may or may not be set and could change overtime.
+
+        When simplifying or quantizing, the size of the coordinates before
+        and after is added to the build stats. Simplifying keeps the edges
+        levels share, so it waits for the rings of every level.
         """
-        while True:
-            try:
-                feature = to_proc.get(True, 1)
-                path = feature[0]
-                color = feature[1][0]
-                if not isinstance(color, str):
-                    color = rgb2hex(color)
-                for coord in path.to_polygons():
-                    polygon_coords = np.around(coord, 3)
-                    value = round(self._data_mappings[color], 2)
-                    feature_polygon = Polygon(
-                        coordinates=polygon_coords.tolist()
-                    )
-                    feature = Feature(
-                        geometry=feature_polygon,
-                        properties={'color': color}
-                    )
-                    feature['properties']['id'] = self._id
-                    feature['properties']['elevation'] = 0.5
-                    feature['properties']['sweep'] = 0
-                    feature['properties']['value'] = value
-                    feature['station'] = self._station
-                    feature['collectiontime'] = self._date
-                    self._features.append(feature)
-                to_proc.task_done()
-            except queue.Empty:
-                if not running.is_set():
-                    break
+        if self._contours is None:
+            return
+        self._features.extend(self._build_features(self._contours))
+
+    def _build_features(self, contours):
+        """Yield the features of each (rings, color) level of contours as soon as
+        the level's rings are available, or once every level's are when
+        simplifying, see _gen_feature_collection.
+        The build stats are set once the last level is done."""
+        start = time.perf_counter()
+        blocks = sys.getallocatedblocks()
+        features = 0
+        vertices = 0
+        vertices_in = 0
+        size_in = 0
+        size = 0
+        compact = self._simplify is not None or self._quantize
+        if self._simplify is not None:
+            levels = list(contours)
+            for rings, _ in levels:
+                vertices_in, size_in = _add_size(rings, vertices_in, size_in, self._DIGITS)
+            contours = zip(simplify_coverage([rings for rings, _ in levels], self._simplify),
+                           [color for _, color in levels])
+        for rings, color in contours:
+            if self._quantize and self._simplify is None:
+                vertices_in, size_in = _add_size(rings, vertices_in, size_in, self._DIGITS)
+            if len(rings) == 0:
+                continue
+            properties = {
+                'color': color,
+                'id': self._id,
+                'elevation': 0.5,
+                'sweep': 0,
+                'value': round(self._data_mappings[color], 2)
+            }
+            template = {
+                'type': 'Feature',
+                'station': self._station,
+                'collectiontime': self._date
+            }
+            geometry = {'type': 'Polygon'}
+            if self._quantize:
+                geometry['encoding'] = 'delta'
+                geometry['digits'] = self._DIGITS
+                rings = quantize_rings(rings, self._DIGITS)
+            else:
+                coords = np.around(np.concatenate(rings), self._DIGITS)
+                rings = np.split(coords, np.cumsum([len(ring) for ring in rings[:-1]]))
+            for ring in rings:
+                vertices += len(ring)
+                feature = dict(template)
+                feature['geometry'] = dict(geometry, coordinates=ring.tolist())
+                feature['properties'] = dict(properties)
+                features += 1
+                if compact:
+                    size += _json_size(feature['geometry']['coordinates'])
+                yield feature
+
+        self._build_stats = {
+            'features': features,
+            'vertices': vertices,
+            'seconds': time.perf_counter() - start,
+            'allocated_blocks': sys.getallocatedblocks() - blocks,
+            'windows': len(self._windows),
+            'smoothed_points': sum(window.size for _, window in self._windows)
+        }
+        logging.info("built {features} features ({vertices} vertices) in {seconds:.3f}s, "
+                     "{allocated_blocks} blocks allocated".format(**self._build_stats))
+        if compact:
+            self._build_stats.update({'vertices_in': vertices_in, 'bytes_in': size_in, 'bytes': size})
+            logging.info("compacted {} from {} to {} vertices, {} to {} bytes of coordinates ({:.0%})".format(
+                self._algorithm, vertices_in, vertices, size_in, size, 1 - size / max(size_in, 1)))
 
     def _set_id(self):
         """Set the unique identifying information for hail contours.
@@ -185,7 +287,7 @@ class GeoJSONConverter:
         """
         self._id = 'S{}C{}'.format(self._station, self._date.strftime('%m%d%Y%H%M'))
 
-    def _set_doc_id(self):
+    def _set_doc_id(self, featurecount=None):
         """Set the unique identifying information for doc.
 
         This will be stored in a related collection, to make
@@ -196,7 +298,7 @@ class GeoJSONConverter:
             'station': self._station,
             'algorithm': self._algorithm,
             'collectiontime': self._date,
-            'featurecount': len(self._features)
+            'featurecount': len(self._features) if featurecount is None else featurecount
         }
 
     def get_relational_id(self):
@@ -212,10 +314,51 @@ class GeoJSONConverter:
         """
         return self._id
 
+    def get_build_stats(self):
+        """return dict with the time taken (s) and the number of features,
+        vertices and memory blocks allocated while building the features,
+        along with the number of windows smoothed and contoured and the
+        points they hold, or None if no features were built. When
+        streaming, the time and blocks include whatever the consumer did
+        between features."""
+        return self._build_stats
+
     def get_features(self):
-        """return list of GeoJSON Features"""
+        """return list of GeoJSON Features, empty until iterated when streaming"""
         return self._features
 
+    def iter_features(self):
+        """Yield each GeoJSON Feature.
+
+        When streaming, the contours of a level are found and turned in to
+        features only once the features of the level before have been
+        consumed, and the relational id and build stats are set after the
+        last one. The features are not kept, so they can only be iterated
+        once. An error contouring or building a level is raised to the
+        consumer, leaving the relational id unset, as the features it
+        already has are only part of the product.
+        """
+        if not self._stream:
+            if self._features != [-1]:
+                yield from self._features
+            return
+        if self._contours is None:
+            return
+        contours, self._contours = self._contours, None
+        count = 0
+        for feature in self._build_features(contours):
+            count += 1
+            yield feature
+        self._set_doc_id(count)
+
+    def iter_batches(self, size):
+        """Yield lists of at most size GeoJSON Features, see iter_features"""
+        features = self.iter_features()
+        batch = list(islice(features, size))
+        while batch:
+            yield batch
+            batch = list(islice(features, size))
+
     def get_metadata(self):
         """return dict with identifying information"""
         return {
@@ -223,3 +366,15 @@ class GeoJSONConverter:
             'algorithm': self._algorithm,
             'collectiontime': self._date
         }
+
+
+def _json_size(coordinates):
+    """Length of the coordinates once serialized to JSON"""
+    return len(json.dumps(coordinates, separators=(',', ':')))
+
+
+def _add_size(rings, vertices, size, digits):
+    """Add the vertices and JSON size of rings to running totals"""
+    vertices += sum(len(ring) for ring in rings)
+    size += sum(_json_size(np.around(ring, digits).tolist()) for ring in rings)
+    return vertices, size
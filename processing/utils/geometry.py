@@ -0,0 +1,214 @@
+"""Caches of radar geometry shared by every scan of a station.
+
+A station's volume coverage pattern fixes its gate ranges and elevation
+angles, so anything derived only from them (i.e. gate heights, ground
+ranges and which samples of each sweep lie above the lowest sweep) is
+computed once per geometry and reused by every following scan.
+Angles are rounded before they are hashed so the small ray to ray jitter
+between scans does not defeat the cache. Gate heights and ground ranges
+are still those of the exact elevations: the cache holds them at the
+rounded elevations together with their rate of change with elevation,
+and each scan's offsets from the rounded angles are applied to them.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from pyart.core import antenna_to_cartesian
+
+ANGLE_RESOLUTION = 0.1  # degrees
+MAX_ENTRIES = 32
+
+
+class LRUCache:
+    """Small thread safe least recently used cache.
+
+    Bounded by max_entries, and by max_bytes when given along with sizeof,
+    a function returning the size in bytes of a value. The most recent
+    value is always kept, even if it alone is larger than max_bytes.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=None, sizeof=None):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes if sizeof is not None else None
+        self._sizeof = sizeof
+        self._sizes = {}
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if self._sizeof is not None:
+                self._sizes[key] = self._sizeof(value)
+            while len(self._items) > self._max_entries or (
+                    len(self._items) > 1 and self._max_bytes is not None and self.nbytes > self._max_bytes):
+                evicted, _ = self._items.popitem(last=False)
+                self._sizes.pop(evicted, None)
+        return value
+
+    @property
+    def nbytes(self):
+        """Total size of the cached values, 0 without sizeof"""
+        return sum(self._sizes.values())
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+
+
+_cartesian = LRUCache()
+_columns = LRUCache()
+_lat_lon = LRUCache()
+
+
+def _rounded(angles):
+    return np.round(np.asarray(angles, dtype=np.float64) / ANGLE_RESOLUTION) * ANGLE_RESOLUTION
+
+
+def geometry_key(radar, azimuth=False):
+    """Hashable key of the gate geometry of a radar.
+
+    Only ranges and elevations are included unless azimuth is True,
+    as those are all gate heights depend on.
+    """
+    digest = hashlib.sha1()
+    digest.update(np.asarray(radar.range['data'], dtype=np.float64).tobytes())
+    digest.update(_rounded(radar.elevation['data']).tobytes())
+    if azimuth:
+        digest.update(_rounded(radar.azimuth['data']).tobytes())
+        digest.update(np.asarray([radar.latitude['data'][0], radar.longitude['data'][0],
+                                  radar.altitude['data'][0]], dtype=np.float64).tobytes())
+    return (radar.nrays, radar.ngates, digest.hexdigest())
+
+
+def _antenna_geometry(ranges, elevations):
+    """(ground range, height) (m) of gates at ranges (m) on rays at elevations (deg)"""
+    rg, eleg = np.meshgrid(ranges, elevations)
+    # with every azimuth at 0 the y coordinate is the ground range
+    _, ground, heights = antenna_to_cartesian(rg / 1000.0, np.zeros_like(rg), eleg)
+    return np.ma.filled(ground, np.nan).astype(np.float64), np.ma.filled(heights, np.nan).astype(np.float64)
+
+
+def _gate_cartesian(radar, key):
+    """(ground range, height) of every gate relative to the antenna (m).
+
+    The geometry at the rounded elevations and its central difference
+    derivative are cached, and the exact elevations are applied as a
+    first order correction. For offsets of up to ANGLE_RESOLUTION / 2 it
+    is within a metre of the exact geometry at 460 km, where using the
+    rounded angles alone moves beams by up to 800 m.
+    """
+    elevations = np.asarray(radar.elevation['data'], dtype=np.float64)
+    rounded = _rounded(elevations)
+    cached = _cartesian.get(key)
+    if cached is None:
+        step = ANGLE_RESOLUTION / 2
+        ground, heights = _antenna_geometry(radar.range['data'], rounded)
+        ground_up, heights_up = _antenna_geometry(radar.range['data'], rounded + step)
+        ground_down, heights_down = _antenna_geometry(radar.range['data'], rounded - step)
+        cached = (ground, heights, (ground_up - ground_down) / (2 * step), (heights_up - heights_down) / (2 * step))
+        for array in cached:
+            array.setflags(write=False)
+        cached = _cartesian.put(key, cached)
+    ground, heights, ground_slope, heights_slope = cached
+    offsets = (elevations - rounded)[:, np.newaxis]
+    if not offsets.any():
+        return ground, heights
+    ground = ground + ground_slope * offsets
+    heights = heights + heights_slope * offsets
+    ground.setflags(write=False)
+    heights.setflags(write=False)
+    return ground, heights
+
+
+def gate_heights(radar, key=None):
+    """Height of every gate above the antenna (m), shape (nrays, ngates).
+
+    The returned array is read only, and shared between scans when their
+    elevations are on ANGLE_RESOLUTION.
+    """
+    if key is None:
+        key = geometry_key(radar)
+    return _gate_cartesian(radar, key)[1]
+
+
+def gate_ground_range(radar, key=None):
+    """Distance along the earth's surface from the radar to every gate (m).
+
+    The returned array is read only, and shared between scans when their
+    elevations are on ANGLE_RESOLUTION.
+    """
+    if key is None:
+        key = geometry_key(radar)
+    return _gate_cartesian(radar, key)[0]
+
+
+def sweep_columns(radar, key=None):
+    """Where each sweep samples the (ray, gate) columns of sweep 0.
+
+    Rays are matched by nearest azimuth and gates by nearest ground range,
+    so sample i of sweep s lies above column i of sweep 0.
+
+    return list with (rays, in_range, gates) per sweep: the sweep's ray
+    (relative to the sweep) above each ray of sweep 0, the sweep 0 gates
+    the sweep reaches and the sweep's gate above each of them
+    """
+    if key is None:
+        key = geometry_key(radar, azimuth=True)
+    cached = _columns.get(key)
+    if cached is None:
+        ground = gate_ground_range(radar)
+        ref_slice = radar.get_slice(0)
+        ref_azimuth = radar.azimuth['data'][ref_slice]
+        ref_ground = ground[ref_slice][0]
+        gate_index = np.arange(radar.ngates, dtype=np.float64)
+        cached = []
+        for sweep in range(radar.nsweeps):
+            sweep_slice = radar.get_slice(sweep)
+            rays = nearest_rays(radar.azimuth['data'][sweep_slice], ref_azimuth)
+            gates = np.interp(ref_ground, ground[sweep_slice][0], gate_index, right=np.nan)
+            in_range = np.isfinite(gates)
+            gates = np.rint(gates[in_range]).astype(np.intp)
+            for array in (rays, in_range, gates):
+                array.setflags(write=False)
+            cached.append((rays, in_range, gates))
+        cached = _columns.put(key, cached)
+    return cached
+
+
+def nearest_rays(azimuths, targets):
+    """Index of the ray in azimuths closest to each of targets (deg)"""
+    diff = np.abs((targets[:, np.newaxis] - azimuths[np.newaxis, :] + 180) % 360 - 180)
+    return np.argmin(diff, axis=1)
+
+
+def gate_lat_lon(radar, sweep=0, filter_transitions=True):
+    """(lats, lons) of every gate of a sweep, as radar.get_gate_lat_lon_alt.
+
+    Keyed on the rounded azimuths as well as the station's position, the
+    returned arrays are shared between scans and are read only.
+    """
+    digest = hashlib.sha1()
+    if filter_transitions and radar.antenna_transition is not None:
+        digest.update(np.asarray(radar.antenna_transition['data'][radar.get_slice(sweep)]).tobytes())
+    key = geometry_key(radar, azimuth=True) + (sweep, filter_transitions, digest.hexdigest())
+    cached = _lat_lon.get(key)
+    if cached is None:
+        lats, lons, _ = radar.get_gate_lat_lon_alt(sweep, False, filter_transitions)
+        lats = np.array(lats, dtype=np.float64)
+        lons = np.array(lons, dtype=np.float64)
+        lats.setflags(write=False)
+        lons.setflags(write=False)
+        cached = _lat_lon.put(key, (lats, lons))
+    return cached
@@ -0,0 +1,215 @@
+"""National MESH mosaic.
+
+Per-station MESH fields overlap, so contouring each station on its own
+produces duplicate and conflicting polygons and costs one set of contours
+per station. The mosaic folds every station's field on to a single fixed
+CONUS latitude/longitude grid, keeping the maximum where stations overlap,
+and groups scans into fixed time windows so each window is contoured once
+for the whole country.
+
+Only cells with hail (MESH > 0) are kept between windows, as flat grid
+indices and values, so an idle window costs nothing and the dense field
+is only built, cropped to the area with hail, when the window is flushed.
+"""
+from datetime import timedelta
+
+import numpy as np
+
+LON_MIN, LON_MAX = -130., -60.
+LAT_MIN, LAT_MAX = 20., 55.
+RESOLUTION = 0.02  # degrees, about 2 km
+WINDOW = timedelta(minutes=5)
+STATION = 'CONUS'
+_PAD = 2  # empty cells kept around the hail so contours close
+_EDGE_TOLERANCE = 1e-6  # cells
+
+
+class NationalGrid:
+    """Fixed latitude/longitude grid covering CONUS
+
+    # Arguments:
+        lon_min, lat_min, lon_max, lat_max: float
+            outer edges of the grid (deg)
+        resolution: float
+            cell size (deg)
+    """
+
+    def __init__(self, lon_min=LON_MIN, lat_min=LAT_MIN, lon_max=LON_MAX, lat_max=LAT_MAX,
+                 resolution=RESOLUTION):
+        self.lon_min = lon_min
+        self.lat_min = lat_min
+        self.resolution = resolution
+        self.shape = (int(round((lat_max - lat_min) / resolution)),
+                      int(round((lon_max - lon_min) / resolution)))
+
+    def flat_indices(self, lons, lats):
+        """return (indices, inside), the flat index of the cell holding each
+        point and whether the point falls on the grid at all"""
+        ny, nx = self.shape
+        cols = np.floor((np.asarray(lons, dtype=np.float64) - self.lon_min) / self.resolution).astype(np.intp)
+        rows = np.floor((np.asarray(lats, dtype=np.float64) - self.lat_min) / self.resolution).astype(np.intp)
+        inside = (rows >= 0) & (rows < ny) & (cols >= 0) & (cols < nx)
+        return rows * nx + cols, inside
+
+    def cover(self, lons, lats, points):
+        """Cells covered by points of a 2-D field.
+
+        Each point stands for the area half way to its farthest neighbour
+        along either axis of the field, in lon and in lat, and goes to every
+        cell with its centre in that area, as well as the cell
+        holding the point, so a field coarser than the grid leaves no holes
+        between the cells its points fall in.
+
+        # Arguments:
+            lons, lats: ndarray
+                2-D coordinates of the field (deg), nan where missing
+            points: ndarray
+                flat indices in to the field of the points to place
+
+        return (indices, sources), the flat index of each covered cell and
+        the flat index in to the field of the point covering it
+        """
+        points = np.asarray(points)
+        half_lon = _half_steps(lons).ravel()[points]
+        half_lat = _half_steps(lats).ravel()[points]
+        lons = np.asarray(lons, dtype=np.float64).ravel()[points]
+        lats = np.asarray(lats, dtype=np.float64).ravel()[points]
+        known = np.isfinite(lons) & np.isfinite(lats)
+        points, lons, lats, half_lon, half_lat = (
+            values[known] for values in (points, lons, lats, half_lon, half_lat))
+        first_col, last_col = _cell_range((lons - self.lon_min) / self.resolution, half_lon / self.resolution)
+        first_row, last_row = _cell_range((lats - self.lat_min) / self.resolution, half_lat / self.resolution)
+
+        ny, nx = self.shape
+        indices, sources = [np.empty(0, dtype=np.intp)], [np.empty(0, dtype=np.intp)]
+        row_span = int((last_row - first_row).max()) if last_row.size else 0
+        col_span = int((last_col - first_col).max()) if last_col.size else 0
+        for row_offset in range(row_span + 1):
+            for col_offset in range(col_span + 1):
+                row, col = first_row + row_offset, first_col + col_offset
+                keep = (row <= last_row) & (col <= last_col) & (row >= 0) & (row < ny) & (col >= 0) & (col < nx)
+                indices.append(row[keep].astype(np.intp) * nx + col[keep].astype(np.intp))
+                sources.append(points[keep])
+        return np.concatenate(indices), np.concatenate(sources)
+
+    def coordinates(self, rows, cols):
+        """return 2-D (lons, lats) of the cell centres in the rows, cols slices"""
+        lons = self.lon_min + (np.arange(cols.start, cols.stop) + 0.5) * self.resolution
+        lats = self.lat_min + (np.arange(rows.start, rows.stop) + 0.5) * self.resolution
+        return np.meshgrid(lons, lats)
+
+
+class Mosaic:
+    """Max-composite of station MESH fields per time window
+
+    # Arguments:
+        window: timedelta
+            length of the time windows scans are grouped in to, windows
+            start on multiples of window since midnight
+        grid: NationalGrid
+            grid the stations are composited on, defaults to CONUS
+    """
+
+    def __init__(self, window=WINDOW, grid=None):
+        self.window = window
+        self.grid = grid if grid is not None else NationalGrid()
+        self._cells = {}  # window start -> list of (flat indices, values)
+        self._stations = {}  # window start -> stations added
+
+    def window_start(self, timestamp):
+        """Start of the window holding timestamp"""
+        midnight = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+        length = self.window.total_seconds()
+        elapsed = (timestamp - midnight).total_seconds()
+        return midnight + timedelta(seconds=(elapsed // length) * length)
+
+    def add(self, station, mesh, lons, lats, timestamp):
+        """Fold a station's 2-D MESH field (mm) in to the window of timestamp
+
+        Each value goes to the national cells it covers (see
+        NationalGrid.cover), so station grids coarser than the national
+        grid are spread over it and finer ones are reduced by their
+        maximum.
+        """
+        start = self.window_start(timestamp)
+        self._stations.setdefault(start, set()).add(station)
+
+        data = np.ma.filled(np.ma.masked_invalid(mesh), 0).ravel()
+        hail = np.flatnonzero(data > 0)
+        if len(hail) == 0:
+            return
+        indices, sources = self.grid.cover(np.ma.filled(np.ma.masked_invalid(lons), np.nan),
+                                           np.ma.filled(np.ma.masked_invalid(lats), np.nan), hail)
+        self._cells.setdefault(start, []).append((indices, data[sources].astype(np.float32)))
+
+    def windows(self):
+        """return the starts of all windows with scans, oldest first"""
+        return sorted(self._stations)
+
+    def composite(self, start):
+        """Remove a window and return its (mesh, lons, lats) cropped to the
+        area with hail, or None when no station in the window saw any"""
+        self._stations.pop(start, None)
+        cells = self._cells.pop(start, [])
+        if len(cells) == 0:
+            return None
+        indices = np.concatenate([cell[0] for cell in cells])
+        values = np.concatenate([cell[1] for cell in cells])
+        if len(indices) == 0:
+            return None
+
+        ny, nx = self.grid.shape
+        rows, cols = np.divmod(indices, nx)
+        rows_slice = slice(max(rows.min() - _PAD, 0), min(rows.max() + 1 + _PAD, ny))
+        cols_slice = slice(max(cols.min() - _PAD, 0), min(cols.max() + 1 + _PAD, nx))
+        mesh = np.zeros((rows_slice.stop - rows_slice.start, cols_slice.stop - cols_slice.start),
+                        dtype=np.float32)
+        np.maximum.at(mesh, (rows - rows_slice.start, cols - cols_slice.start), values)
+        lons, lats = self.grid.coordinates(rows_slice, cols_slice)
+        return mesh, lons, lats
+
+    def flush(self, before=None):
+        """Composite and remove every window which ended by before (all
+        windows when before is None), oldest first.
+
+        yield (start, stations, (mesh, lons, lats)) for each window with hail
+        """
+        for start in self.windows():
+            if before is not None and start + self.window > before:
+                break
+            stations = self._stations.get(start, set())
+            mesh = self.composite(start)
+            if mesh is not None:
+                yield start, stations, mesh
+
+
+def _cell_range(positions, halves):
+    """First and last cell with its centre in [position - half, position + half)
+    of each position, in cells, as well as the cell holding the position.
+
+    Footprints of neighbouring points meet exactly, so the edges are moved
+    by _EDGE_TOLERANCE for a cell centre on an edge to always fall in one
+    of them despite rounding.
+    """
+    cells = np.floor(positions)
+    first = np.minimum(np.ceil(positions - halves - 0.5 - _EDGE_TOLERANCE), cells)
+    last = np.maximum(np.ceil(positions + halves - 0.5 - _EDGE_TOLERANCE) - 1, cells)
+    return first, last
+
+
+def _half_steps(coords):
+    """Half the step from each point of a 2-D coordinate array to its
+    farthest neighbour along either axis, 0 where it is unknown"""
+    coords = np.asarray(coords, dtype=np.float64)
+    halves = np.zeros(coords.shape)
+    if coords.ndim != 2:
+        return halves
+    for axis in (0, 1):
+        if coords.shape[axis] < 2:
+            continue
+        steps = np.abs(np.diff(coords, axis=axis))
+        before, after = [[(0, 0), (0, 0)] for _ in range(2)]
+        before[axis], after[axis] = (1, 0), (0, 1)
+        halves = np.fmax(halves, np.fmax(np.pad(steps, before, constant_values=np.nan),
+                                         np.pad(steps, after, constant_values=np.nan)) / 2)
+    return np.nan_to_num(halves)
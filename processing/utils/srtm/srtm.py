@@ -4,10 +4,29 @@ corrective beam blocking for HSDA"""
 import logging
 import os
 
-from processing.utils.nexrad_stations import _radar_stations
+from processing.utils.srtm import tiles
+
 
 def srtm(station):
+    """Return the station's GeoTIFF if present, otherwise its prebuilt tile.
+
+    When neither exists "UNDEF" is returned and the tile is built in the
+    background from Entire_US_SRTM.zip, so it is available for later scans.
+    Stations known to lie outside of the archive get "UNDEF" straight away.
+    """
     file = os.getcwd() + "/processing/utils/srtm/{}.tif".format(station)
     if os.path.isfile(file):
         return file
+    file = tiles.tile_path(station)
+    if file is not None:
+        return file
+    if tiles.unavailable(station):
+        return "UNDEF"
+    if tiles.build_in_background([station.upper()]) is not None:
+        logging.info("SRTM tile for {} is being built".format(station))
     return "UNDEF"
+
+
+def prepare(stations):
+    """Start building any missing tiles for stations without waiting on them"""
+    return tiles.build_in_background([station.upper() for station in stations])
@@ -0,0 +1,148 @@
+"""Terrain service used to calculate beam blocking for HSDA.
+
+Reading a station's SRTM GeoTIFF is the most expensive part of the
+beam blocking calculation, so the raster is read once per station,
+clipped to the station's maximum range and kept as a memory-mapped
+float32 DEM. Every tilt of every scan then reads its bounding box
+window from that DEM instead of re-opening the GeoTIFF.
+"""
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import wradlib as wrl
+from osgeo import gdal
+
+from processing.utils.srtm import tiles
+
+_NODATA = -32768.
+_PAD = 2  # pixels kept around a window so the cubic spline has neighbours
+_MARGIN = 0.05  # degrees added around the station's maximum range
+
+_terrains = {}
+_lock = threading.Lock()
+
+
+class StationTerrain:
+    """Clipped DEM for a single station
+
+    # Arguments:
+        values: ndarray
+            2-D elevations (m), usually a read only float32 or int16 memmap
+        geotransform: tuple
+            GDAL style geotransform (x0, dx, 0, y0, 0, dy) of values
+    """
+
+    def __init__(self, values, geotransform):
+        self.values = values
+        self.geotransform = tuple(geotransform)
+
+    @classmethod
+    def from_raster(cls, srtm_ffn, rlimits, cache_file):
+        """Read only the rlimits window of a raster and memory-map it to cache_file"""
+        ds = gdal.Open(srtm_ffn)
+        if ds is None:
+            raise FileNotFoundError("Unable to open raster {}".format(srtm_ffn))
+        x0, dx, _, y0, _, dy = ds.GetGeoTransform()
+        col0, col1, row0, row1 = _window_indices(
+            (x0, dx, 0, y0, 0, dy), rlimits, ds.RasterYSize, ds.RasterXSize)
+
+        band = ds.GetRasterBand(1)
+        values = band.ReadAsArray(col0, row0, col1 - col0, row1 - row0).astype(np.float32)
+        nodata = band.GetNoDataValue()
+        if nodata is not None:
+            values[values == nodata] = _NODATA
+        ds = None
+
+        geotransform = (x0 + col0 * dx, dx, 0, y0 + row0 * dy, 0, dy)
+        np.save(cache_file, values)
+        return cls(np.load(cache_file, mmap_mode='r'), geotransform)
+
+    def window(self, rlimits):
+        """Return (coords, values) of the DEM inside rlimits
+
+        coords has the same (rows, cols, 2) layout of pixel centres as
+        wradlib.georef.extract_raster_dataset so it can be passed to
+        wradlib.ipol.cart_to_irregular_spline unchanged.
+        """
+        x0, dx, _, y0, _, dy = self.geotransform
+        col0, col1, row0, row1 = _window_indices(
+            self.geotransform, rlimits, *self.values.shape)
+        x = x0 + (np.arange(col0, col1) + 0.5) * dx
+        y = y0 + (np.arange(row0, row1) + 0.5) * dy
+        coords = np.dstack(np.meshgrid(x, y))
+        return coords, np.asarray(self.values[row0:row1, col0:col1], dtype=np.float32)
+
+
+def _window_indices(geotransform, rlimits, nrows, ncols):
+    """Pixel bounds (col0, col1, row0, row1) of rlimits, padded and clamped"""
+    x0, dx, _, y0, _, dy = geotransform
+    lon_min, lat_min, lon_max, lat_max = rlimits
+    cols = sorted(((lon_min - x0) / dx, (lon_max - x0) / dx))
+    rows = sorted(((lat_min - y0) / dy, (lat_max - y0) / dy))
+    col0 = max(int(np.floor(cols[0])) - _PAD, 0)
+    col1 = min(int(np.ceil(cols[1])) + _PAD, ncols)
+    row0 = max(int(np.floor(rows[0])) - _PAD, 0)
+    row1 = min(int(np.ceil(rows[1])) + _PAD, nrows)
+    return col0, col1, row0, row1
+
+
+def _range_limits(sitecoords, max_range, elevation):
+    """Bounding box (lon_min, lat_min, lon_max, lat_max) of a station's range ring"""
+    azimuths = np.arange(0, 360, 0.5)
+    ring = wrl.georef.spherical_to_proj(
+        np.full(azimuths.shape, max_range), azimuths,
+        np.full(azimuths.shape, elevation), sitecoords)
+    return (ring[..., 0].min() - _MARGIN, ring[..., 1].min() - _MARGIN,
+            ring[..., 0].max() + _MARGIN, ring[..., 1].max() + _MARGIN)
+
+
+def get_terrain(srtm_ffn, sitecoords, max_range, elevation=0.):
+    """Get the clipped DEM for a station, loading it on first use.
+
+    # Arguments:
+        srtm_ffn: str
+            path to the SRTM raster or prebuilt tile covering the station
+        sitecoords: tuple
+            (lon, lat, alt) of the radar
+        max_range: float
+            furthest gate of the station (m)
+        elevation: float
+            lowest elevation angle (deg), which has the widest footprint
+    """
+    key = (srtm_ffn, round(float(sitecoords[0]), 4), round(float(sitecoords[1]), 4),
+           int(max_range))
+    with _lock:
+        terrain = _terrains.get(key)
+        if terrain is not None:
+            return terrain
+
+        if srtm_ffn.endswith('.npy'):
+            # Prebuilt tiles are already clipped to the station's range
+            terrain = StationTerrain(*tiles.load_tile(srtm_ffn))
+            _terrains[key] = terrain
+            return terrain
+
+        cachedir = os.getcwd() + '/.terrain/'
+        if not os.path.isdir(cachedir):
+            os.mkdir(cachedir, 0o777)
+        name = '{}_{}_{}_{}'.format(
+            os.path.splitext(os.path.basename(srtm_ffn))[0], key[1], key[2], key[3])
+        cache_file = cachedir + name + '.npy'
+        meta_file = cachedir + name + '.json'
+
+        if os.path.isfile(cache_file) and os.path.isfile(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            terrain = StationTerrain(np.load(cache_file, mmap_mode='r'), meta['geotransform'])
+        else:
+            logging.info("Clipping terrain for {} from {}".format(key[1:3], srtm_ffn))
+            rlimits = _range_limits(sitecoords, max_range, elevation)
+            terrain = StationTerrain.from_raster(srtm_ffn, rlimits, cache_file)
+            with open(meta_file, 'w') as f:
+                json.dump({'geotransform': terrain.geotransform, 'rlimits': rlimits}, f)
+
+        _terrains[key] = terrain
+        return terrain
@@ -0,0 +1,216 @@
+"""Preprocessing tool and lazy loader for per-station SRTM tiles.
+
+The repo ships the whole CONUS SRTM raster as Entire_US_SRTM.zip. This
+module extracts a station centred window of it for every NEXRAD station,
+resamples it, and stores it as an int16 .npy tile which can be memory
+mapped. An index.json next to the tiles records each tile's file and
+geotransform, so looking up a station's terrain never touches the zip.
+Stations outside of the raster (i.e. PGUA, TJUA) are recorded in the
+index without a file, so they are not attempted again on every scan.
+
+Build all tiles ahead of time with:
+
+    python3 -m processing.utils.srtm.tiles
+"""
+import json
+import logging
+import os
+import sys
+import threading
+
+import numpy as np
+
+from processing.utils.nexrad_stations import _radar_stations
+
+SRTM_ZIP = os.getcwd() + '/Entire_US_SRTM.zip'
+SRTM_TIF = 'EntireUS.tif'
+TILE_DIR = os.getcwd() + '/processing/utils/srtm/tiles/'
+INDEX_FILE = TILE_DIR + 'index.json'
+RESOLUTION = 0.005  # degrees, roughly 500 m
+NODATA = -32768
+
+_RANGE_FILE = os.path.dirname(os.path.abspath(__file__)) + '/station_range_coordinates.txt'
+_HALF_HEIGHT = 4.1298  # degrees of latitude covering the 460 km range ring
+
+# Stations missing from station_range_coordinates.txt, (lat, lon) of the radar
+_STATION_CENTRES = {
+    "KCRI": (35.238, -97.460), "KDFX": (29.273, -100.281), "KFSX": (34.574, -111.198),
+    "KFTG": (39.786, -104.546), "KLNX": (41.958, -100.576), "KMBX": (48.393, -100.864),
+    "KMPX": (44.849, -93.566), "KOTX": (47.680, -117.627), "KTBW": (27.706, -82.402),
+    "KVAX": (30.890, -83.002)
+}
+
+_index = None
+_index_mtime = None
+_lock = threading.Lock()
+_building = set()
+
+
+def station_bounds():
+    """Map every station to its (lon_min, lat_min, lon_max, lat_max) window"""
+    bounds = {}
+    with open(_RANGE_FILE) as f:
+        for line in f:
+            tokens = line.split()
+            if len(tokens) != 7:
+                continue
+            lat_min, lat_max = float(tokens[2]), float(tokens[3])
+            lon_min, lon_max = float(tokens[5]), float(tokens[6])
+            bounds[tokens[0]] = (lon_min, lat_min, lon_max, lat_max)
+    for station, (lat, lon) in _STATION_CENTRES.items():
+        half_width = _HALF_HEIGHT / np.cos(np.radians(lat))
+        bounds.setdefault(station, (lon - half_width, lat - _HALF_HEIGHT,
+                                    lon + half_width, lat + _HALF_HEIGHT))
+    return bounds
+
+
+def read_index():
+    """Return the tile index, re-reading index.json only when it changes"""
+    global _index, _index_mtime
+    try:
+        mtime = os.path.getmtime(INDEX_FILE)
+    except OSError:
+        return {}
+    if _index is None or mtime != _index_mtime:
+        with open(INDEX_FILE) as f:
+            _index = json.load(f)
+        _index_mtime = mtime
+    return _index
+
+
+def tile_path(station):
+    """Path of a station's tile, or None if it has not been built"""
+    entry = read_index().get(station.upper())
+    if entry is None or entry.get('file') is None:
+        return None
+    path = TILE_DIR + entry['file']
+    return path if os.path.isfile(path) else None
+
+
+def unavailable(station):
+    """True when a tile can never be built for the station, i.e. it lies
+    outside of the SRTM raster, so callers go straight to no terrain"""
+    entry = read_index().get(station.upper())
+    return entry is not None and entry.get('file') is None
+
+
+def load_tile(path):
+    """Memory-map a tile built by this module.
+
+    return (values, geotransform), values being a read only int16 array
+    """
+    station = os.path.splitext(os.path.basename(path))[0]
+    entry = read_index()[station]
+    return np.load(path, mmap_mode='r'), tuple(entry['geotransform'])
+
+
+def build_tiles(stations=None, resolution=RESOLUTION, overwrite=False):
+    """Extract, resample and store a tile for each station.
+
+    # Arguments:
+        stations: list
+            stations to build tiles for, defaults to all NEXRAD stations
+        resolution: float
+            output pixel size in degrees
+        overwrite: bool
+            rebuild tiles which already exist
+    """
+    from osgeo import gdal
+
+    if stations is None:
+        stations = _radar_stations
+    if not os.path.isfile(SRTM_ZIP):
+        logging.error("SRTM archive {} not found".format(SRTM_ZIP))
+        return []
+    if not os.path.isdir(TILE_DIR):
+        os.makedirs(TILE_DIR, 0o777)
+
+    ds = gdal.Open('/vsizip/{}/{}'.format(SRTM_ZIP, SRTM_TIF))
+    if ds is None:
+        logging.error("Unable to open {} inside {}".format(SRTM_TIF, SRTM_ZIP))
+        return []
+    x0, dx, _, y0, _, dy = ds.GetGeoTransform()
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    bounds = station_bounds()
+
+    built = []
+    for station in stations:
+        if station not in bounds:
+            logging.warning("No range window known for {}, skipping tile".format(station))
+            _add_to_index(station, {'file': None, 'reason': 'no range window'})
+            continue
+        if not overwrite and tile_path(station) is not None:
+            continue
+
+        lon_min, lat_min, lon_max, lat_max = bounds[station]
+        col0 = max(int(np.floor((lon_min - x0) / dx)), 0)
+        col1 = min(int(np.ceil((lon_max - x0) / dx)), ds.RasterXSize)
+        row0 = max(int(np.floor((lat_max - y0) / dy)), 0)
+        row1 = min(int(np.ceil((lat_min - y0) / dy)), ds.RasterYSize)
+        if col1 <= col0 or row1 <= row0:
+            logging.warning("{} lies outside of the SRTM raster, skipping tile".format(station))
+            _add_to_index(station, {'file': None, 'reason': 'outside of the SRTM raster'})
+            continue
+
+        out_cols = max(int(round((col1 - col0) * abs(dx) / resolution)), 1)
+        out_rows = max(int(round((row1 - row0) * abs(dy) / resolution)), 1)
+        values = band.ReadAsArray(col0, row0, col1 - col0, row1 - row0,
+                                  buf_xsize=out_cols, buf_ysize=out_rows,
+                                  resample_alg=gdal.GRIORA_Average)
+        if nodata is not None:
+            values[values == nodata] = NODATA
+        values = np.clip(np.nan_to_num(values, nan=NODATA), NODATA, 32767).astype(np.int16)
+
+        out_dx = (col1 - col0) * dx / out_cols
+        out_dy = (row1 - row0) * dy / out_rows
+        geotransform = (x0 + col0 * dx, out_dx, 0, y0 + row0 * dy, 0, out_dy)
+        filename = '{}.npy'.format(station)
+        np.save(TILE_DIR + filename, values)
+        _add_to_index(station, {'file': filename, 'geotransform': geotransform,
+                                'shape': values.shape, 'resolution': resolution})
+        logging.info("Built SRTM tile for {} {}".format(station, values.shape))
+        built.append(station)
+
+    ds = None
+    return built
+
+
+def _add_to_index(station, entry):
+    """Atomically add a tile to index.json"""
+    with _lock:
+        index = dict(read_index())
+        index[station] = entry
+        tmp = INDEX_FILE + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, INDEX_FILE)
+
+
+def build_in_background(stations):
+    """Build missing tiles on a daemon thread so processing is never blocked"""
+    with _lock:
+        missing = [station for station in stations
+                   if station not in _building and tile_path(station) is None and not unavailable(station)]
+        if len(missing) == 0 or not os.path.isfile(SRTM_ZIP):
+            return None
+        _building.update(missing)
+
+    def _run():
+        try:
+            build_tiles(missing)
+        except Exception as e:
+            logging.error("Error occurred while building SRTM tiles. {}".format(e))
+        finally:
+            with _lock:
+                _building.difference_update(missing)
+
+    thread = threading.Thread(target=_run, daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    built = build_tiles(sys.argv[1:] or None, overwrite=len(sys.argv) > 1)
+    print("{} tiles built in {}".format(len(built), TILE_DIR))
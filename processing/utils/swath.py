@@ -0,0 +1,115 @@
+"""Daily hail swath.
+
+The maximum hail size over a day is kept as a running maximum on the
+national grid instead of being rebuilt from every scan's contours. Each
+day has two memory-mapped arrays, the largest MESH seen in every cell and
+the time it was seen, which are updated as each scan is processed and
+contoured on demand, so building the swath costs the same however many
+scans went in to it.
+"""
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+
+from processing.utils.geojson_converter import GeoJSONConverter
+from processing.utils.mosaic import NationalGrid, STATION
+
+SWATH_DIR = os.getcwd() + '/processing/utils/swath/'
+NO_TIME = -1
+_PAD = 2  # empty cells kept around the hail so contours close
+
+
+class DailySwath:
+    """Running maximum MESH and its time for a single day
+
+    # Arguments:
+        day: date
+            day the swath covers, scans are folded in by their own time
+        directory: str
+            where the memory-mapped arrays are kept, created if needed
+        grid: NationalGrid
+            grid the swath is kept on, defaults to CONUS
+    """
+
+    def __init__(self, day, directory=SWATH_DIR, grid=None):
+        self.day = day
+        self.grid = grid if grid is not None else NationalGrid()
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o777, exist_ok=True)
+        name = directory + day.strftime('%Y%m%d')
+        self._max = _open_memmap(name + '_max.npy', np.float32, 0, self.grid.shape)
+        self._time = _open_memmap(name + '_time.npy', np.int32, NO_TIME, self.grid.shape)
+
+    def update(self, mesh, lons, lats, timestamp):
+        """Fold a 2-D MESH field (mm) in to the swath
+
+        Each value goes to the cells it covers, see NationalGrid.cover.
+        Cells where mesh beats the running maximum take its value and
+        timestamp's seconds since midnight as their time of max. Timezone
+        aware timestamps, as the scans carry, are taken in UTC and naive
+        ones as already being UTC.
+        """
+        data = np.ma.filled(np.ma.masked_invalid(mesh), 0).ravel()
+        hail = np.flatnonzero(data > 0)
+        if len(hail) == 0:
+            return 0
+        indices, sources = self.grid.cover(np.ma.filled(np.ma.masked_invalid(lons), np.nan),
+                                           np.ma.filled(np.ma.masked_invalid(lats), np.nan), hail)
+        values = data[sources].astype(np.float32)
+
+        # Keep the largest value of points sharing a cell
+        order = np.lexsort((values, indices))
+        indices, values = indices[order], values[order]
+        last = np.append(indices[1:] != indices[:-1], True)
+        indices, values = indices[last], values[last]
+
+        current = self._max.reshape(-1)
+        larger = values > current[indices]
+        indices = indices[larger]
+        current[indices] = values[larger]
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        midnight = datetime.combine(self.day, datetime.min.time())
+        self._time.reshape(-1)[indices] = int((timestamp - midnight).total_seconds())
+        self._max.flush()
+        self._time.flush()
+        return len(indices)
+
+    def swath(self):
+        """return (mesh, lons, lats, times) cropped to the area with hail,
+        times being the seconds after midnight each cell's maximum was
+        seen (masked where it never was), or None when there has been
+        no hail"""
+        rows = np.flatnonzero(np.any(self._max > 0, axis=1))
+        if len(rows) == 0:
+            return None
+        cols = np.flatnonzero(np.any(self._max[rows[0]:rows[-1] + 1] > 0, axis=0))
+        ny, nx = self.grid.shape
+        rows = slice(max(rows[0] - _PAD, 0), min(rows[-1] + 1 + _PAD, ny))
+        cols = slice(max(cols[0] - _PAD, 0), min(cols[-1] + 1 + _PAD, nx))
+
+        mesh = np.array(self._max[rows, cols])
+        times = np.ma.masked_equal(self._time[rows, cols], NO_TIME)
+        lons, lats = self.grid.coordinates(rows, cols)
+        return mesh, lons, lats, times
+
+    def contour(self, levels=None):
+        """return a GeoJSONConverter of the day's swath, or None when
+        there has been no hail"""
+        swath = self.swath()
+        if swath is None:
+            return None
+        mesh, lons, lats, _ = swath
+        # Same (lon, lat) vertex order as the per-scan MESH contours
+        return GeoJSONConverter(mesh, lons, lats, 'MESH_SWATH', STATION,
+                                datetime.combine(self.day, datetime.min.time()), levels=levels)
+
+
+def _open_memmap(filename, dtype, fill, shape):
+    """Open a .npy memmap for update, creating it filled with fill"""
+    if os.path.isfile(filename):
+        return np.load(filename, mmap_mode='r+')
+    array = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+    array[:] = fill
+    return array
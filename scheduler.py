@@ -12,6 +12,21 @@ import schedule
 from processing.data import Data
 
 CONFIG_CALC_HSDA = False
+CONFIG_MEHS_ENGINE = 'grid'  # 'grid', 'sparse' or 'polar'
+CONFIG_MEHS_ADAPTIVE = False
+CONFIG_MEHS_MOSAIC = False  # contour one national MESH mosaic instead of every station
+CONFIG_MEHS_SWATH = False  # keep the daily maximum MESH swath up to date
+CONFIG_SWEEPS = 'lowest'  # 'lowest' or 'all' for vertical composites of HDR and HSDA
+CONFIG_INDEX_CONTOURS = False  # contour on array indices, transforming only the vertices
+CONFIG_SIMPLIFY_METRES = None  # e.g. 250 to simplify contours to within 250 m
+CONFIG_QUANTIZE = False  # store contour coordinates as delta encoded integers
+CONFIG_TRIAGE = False  # skip scans whose lowest sweep cannot hold hail
+CONFIG_CONTOUR_WORKERS = 1  # processes contouring products, e.g. os.cpu_count()
+CONFIG_UPLOAD_BATCH = None  # e.g. 500 to insert features in batches while contouring
+CONFIG_TILES = None  # e.g. 'hail.mbtiles' to keep vector tiles of the products
+CONFIG_COLUMNAR_DIR = None  # e.g. 'processing/export/columnar/' to also write products as columnar files
+CONFIG_COLUMNAR_PERIOD = 'scan'  # 'scan' or 'hour' per file
+CONFIG_DELTA = False  # store levels unchanged since a station's last scan as references
 TRIGGER_TIME = "07:00"
 
 logging.basicConfig(level=logging.INFO)
@@ -23,7 +38,14 @@ def process_radar():
         dt_time = time.fromisoformat('00:00:00.000000')
         start_time = datetime.combine(date.today(), dt_time.min)
         end_time = datetime.combine(date.today(), dt_time.max)
-        _ = Data(start_time, end_time, HSDA=CONFIG_CALC_HSDA)
+        _ = Data(start_time, end_time, HSDA=CONFIG_CALC_HSDA, mehs_engine=CONFIG_MEHS_ENGINE,
+                 mehs_adaptive=CONFIG_MEHS_ADAPTIVE, mosaic=CONFIG_MEHS_MOSAIC,
+                 swath=CONFIG_MEHS_SWATH, sweeps=CONFIG_SWEEPS,
+                 index_contours=CONFIG_INDEX_CONTOURS, simplify=CONFIG_SIMPLIFY_METRES,
+                 quantize=CONFIG_QUANTIZE, triage=CONFIG_TRIAGE,
+                 contour_workers=CONFIG_CONTOUR_WORKERS, upload_batch=CONFIG_UPLOAD_BATCH,
+                 tiles=CONFIG_TILES, columnar=CONFIG_COLUMNAR_DIR, columnar_period=CONFIG_COLUMNAR_PERIOD,
+                 delta=CONFIG_DELTA)
     except:
         logging.error(traceback.format_exc())
         logging.info("Job process_radar completed with error(s)")
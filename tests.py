@@ -19,11 +19,28 @@ from processing.utils.radiosonde_mappings import _radiosonde_station as _station
 from processing.downloaders.nexrad_downloader import RadarDownloader
 from processing.downloaders.sonde_downloader import SondeDownloader
 from processing.utils.srtm.srtm import srtm
+from processing.utils.srtm import tiles as srtm_tiles
 
 ''' Algorithms '''
-from processing.algorithms.hdr import HailDifferentialReflectivity
+from processing.algorithms.hdr import HailDifferentialReflectivity, calculate_hdr
 from processing.algorithms.mehs import MaximumExpectedHailSize
 from processing.algorithms.hsda import main as hsda
+from processing.algorithms.kdp import kdp_from_phidp
+from processing.algorithms.composite import column_max, lowest_sweep_composite
+from processing.algorithms.triage import Triage, TriageReport
+
+''' Database '''
+import processing.db.db_connection as db
+
+''' Products '''
+from processing.utils import geometry
+from processing.utils.contour import filled_contours, level_colors, decode_ring, simplify_coverage
+from processing.utils.geojson_converter import GeoJSONConverter
+from processing.utils.mosaic import Mosaic
+from processing.utils.swath import DailySwath
+from processing.utils.delta import DeltaEncoder
+from processing.export.tiles import TileCache
+from processing.export.columnar import read_columns, ring_from_wkb, to_features, write_features
 
 
 
@@ -32,6 +49,15 @@ NEXRAD_DOWNLOADER_TESTS = True
 HAIL_DIFFERENTIAL_REFLECTIVITY_TESTS = True
 MAXIMUM_EXPECTED_HAIL_SIZE_TESTS = True
 HAIL_SIZE_DISCRIMINATION_ALGORITHM_TESTS = True
+KDP_TESTS = True
+TRIAGE_TESTS = True
+MOSAIC_TESTS = True
+CONTOUR_TESTS = True
+TILES_TESTS = True
+COLUMNAR_TESTS = True
+DELTA_TESTS = True
+DB_TESTS = True
+SRTM_TESTS = True
 
 
 ''' NEXRAD Downloader Tests '''
@@ -343,7 +369,72 @@ if HAIL_DIFFERENTIAL_REFLECTIVITY_TESTS:
     HDR_object_initialization_with_nondefault_radars_success()
     HDR_object_apply_algorithm_success()
     HDR_object_set_radars_success()
+    def HDR_kernel_matches_reference_success():
+        import numpy as np
+
+        z = np.ma.masked_less(np.linspace(-10, 70, 400, dtype=np.float32).reshape(20, 20), 0)
+        zdr = np.ma.masked_array(np.linspace(-2, 4, 400, dtype=np.float32).reshape(20, 20))
+        zdr[0, 0] = np.ma.masked
+
+        gzdr = (19 * zdr) + 27
+        gzdr[zdr <= 0] = 27
+        gzdr[zdr > 1.74] = 60
+        expected = z - gzdr
+
+        hdr = calculate_hdr(z, zdr)
+
+        assert(hdr.dtype == np.float32)
+        assert((hdr.mask == np.ma.getmaskarray(expected)).all())
+        assert(np.allclose(hdr.compressed(), expected.compressed(), atol=1e-4))
+
+        print("Test \'HDR_kernel_matches_reference_success\' Passed Assertions")
+
+    def HDR_batch_of_scans_success():
+        import numpy as np
+
+        station = random.choice(station_list)  # Chooses random NEXRAD station
+        start = datetime.now() - timedelta(days=0, hours=24, minutes=0,
+                                           seconds=0)  # Set as current time minus 24 hours
+        end = start + timedelta(minutes=30)
+
+        downloader = RadarDownloader((station,), start, end)
+
+        radars = [downloader.get_radar(0).extract_sweeps([0]) for _ in range(2)]
+        expected = HailDifferentialReflectivity(downloader.get_radar(0).extract_sweeps([0])).get_radar()
+
+        radars = HailDifferentialReflectivity.apply_batch(radars)
+
+        for radar in radars:
+            assert(np.ma.allclose(radar.fields['HDR']['data'], expected.fields['HDR']['data']))
+
+        print("Test \'HDR_batch_of_scans_success\' Passed Assertions")
+
+    def HDR_column_max_composite_over_volume_success():
+        import numpy as np
+
+        station = random.choice(station_list)  # Chooses random NEXRAD station
+        start = datetime.now() - timedelta(days=0, hours=24, minutes=0,
+                                           seconds=0)  # Set as current time minus 24 hours
+        end = start + timedelta(minutes=30)
+
+        downloader = RadarDownloader((station,), start, end)
+
+        radar = HailDifferentialReflectivity(downloader.get_radar(0)).get_radar()
+        composite = lowest_sweep_composite(radar, {'HDR': column_max})
+
+        lowest = radar.fields['HDR']['data'][radar.get_slice(0)]
+        hdr = composite.fields['HDR']['data']
+        assert(composite.nsweeps == 1)
+        assert(hdr.shape == lowest.shape)
+        both = ~np.ma.getmaskarray(lowest) & ~np.ma.getmaskarray(hdr)
+        assert((hdr[both] >= lowest[both] - 1e-4).all())
+
+        print("Test \'HDR_column_max_composite_over_volume_success\' Passed Assertions")
+
     HDR_object_retrieve_processed_radar_success()
+    HDR_kernel_matches_reference_success()
+    HDR_batch_of_scans_success()
+    HDR_column_max_composite_over_volume_success()
 
 if MAXIMUM_EXPECTED_HAIL_SIZE_TESTS:
     print("Beginning Unit Test Subpackage: MAXIMUM_EXPECTED_HAIL_SIZE_TESTS")
@@ -422,12 +513,712 @@ if MAXIMUM_EXPECTED_HAIL_SIZE_TESTS:
 
         print("Test \'MESH_retrieve_grid_success\' Passed Assertions")
 
+    def MESH_polar_engine_within_tolerance_of_grid_success():
+        import numpy as np
+        from scipy.spatial import cKDTree
+
+        grid_mesh, grid_lons, grid_lats = MaximumExpectedHailSize(radar, alts).get_mesh()
+        polar_mesh, lons, lats = MaximumExpectedHailSize(radar, alts, engine='polar').get_mesh()
+
+        assert(polar_mesh.shape == lons.shape == lats.shape)
+
+        # Compare every polar gate with the grid cell nearest to it, where MESH > 10 mm
+        _, nearest = cKDTree(np.column_stack((grid_lons.ravel(), grid_lats.ravel()))).query(
+            np.column_stack((lons.ravel(), lats.ravel())))
+        expected = np.ma.filled(grid_mesh, 0).ravel()[nearest]
+        actual = np.ma.filled(polar_mesh, np.nan).ravel()
+        compared = (expected > 10) & np.isfinite(actual)
+        np.testing.assert_allclose(actual[compared], expected[compared], rtol=0.1)
+
+        print("Test \'MESH_polar_engine_within_tolerance_of_grid_success\' Passed Assertions")
+
+    def MESH_sparse_engine_matches_grid_success():
+        import numpy as np
+
+        grid = MaximumExpectedHailSize(radar, alts).get_grid()
+        sparse_grid = MaximumExpectedHailSize(radar, alts, engine='sparse').get_grid()
+
+        expected = grid.fields['reflectivity']['data']
+        actual = sparse_grid.fields['reflectivity']['data']
+        assert(actual.shape == expected.shape)
+
+        # Only the edges of the radius of influence may differ in coverage
+        expected_mask, actual_mask = np.ma.getmaskarray(expected), np.ma.getmaskarray(actual)
+        assert(np.mean(expected_mask != actual_mask) < 0.01)
+        valid = ~expected_mask & ~actual_mask
+        np.testing.assert_allclose(actual.data[valid], expected.data[valid], atol=2)
+
+        print("Test \'MESH_sparse_engine_matches_grid_success\' Passed Assertions")
+
+    def MESH_sparse_engine_detects_shared_azimuths_success():
+        import numpy as np
+        from processing.algorithms import mehs
+
+        scan = pyart.testing.make_empty_ppi_radar(10, 360, 1)
+        scan.azimuth['data'] = np.arange(360) + 0.5
+        assert(mehs._canonical_rays(scan)[2] == 0)
+
+        scan.azimuth['data'][1] = scan.azimuth['data'][0]
+        positions, _, collisions = mehs._canonical_rays(scan)
+        assert(collisions == 1)
+        assert(positions[0] == positions[1])
+
+        print("Test \'MESH_sparse_engine_detects_shared_azimuths_success\' Passed Assertions")
+
+    def MESH_weights_cache_bounded_by_size_success():
+
+        cache = geometry.LRUCache(max_bytes=100, sizeof=len)
+        cache.put('a', b'x' * 60)
+        cache.put('b', b'x' * 30)
+        assert(cache.get('a') is not None and cache.nbytes == 90)
+
+        cache.put('c', b'x' * 50)
+        assert(cache.get('b') is None and cache.get('a') is None)
+        assert(cache.nbytes == 50)
+
+        cache.put('d', b'x' * 200)
+        assert(cache.get('d') is not None and cache.nbytes == 200)
+
+        print("Test \'MESH_weights_cache_bounded_by_size_success\' Passed Assertions")
+
+    def MESH_column_products_on_grid_success():
+
+        grid = MaximumExpectedHailSize(radar, alts).get_grid()
+
+        for field in ('MESH', 'SHI', 'VIL', 'ET50'):
+            assert(grid.fields[field]['data'].shape == (1, ) + grid.fields['reflectivity']['data'].shape[1:])
+        assert(grid.fields['VIL']['data'].min() >= 0)
+
+        print("Test \'MESH_column_products_on_grid_success\' Passed Assertions")
+
+    def MESH_gate_heights_follow_exact_elevations_success():
+        import numpy as np
+        from pyart.core import antenna_to_cartesian
+
+        scans = []
+        for elevation in (0.5, 0.54):
+            scan = pyart.testing.make_empty_ppi_radar(460, 360, 1)
+            scan.range['data'] = np.arange(460) * 1000. + 500.
+            scan.elevation['data'][:] = elevation
+            scans.append(scan)
+
+        # Both scans share the cached geometry of 0.5 deg
+        assert(geometry.geometry_key(scans[0]) == geometry.geometry_key(scans[1]))
+        for scan in scans:
+            heights = geometry.gate_heights(scan)
+            ranges, elevations = np.meshgrid(scan.range['data'], scan.elevation['data'])
+            _, _, expected = antenna_to_cartesian(ranges / 1000., np.zeros_like(ranges), elevations)
+            assert(np.abs(heights - expected).max() < 1.)
+
+        print("Test \'MESH_gate_heights_follow_exact_elevations_success\' Passed Assertions")
+
     MESH_initialization_with_correct_inputs_success()
     MESH_initialization_with_no_radar_inputs_failure()
     MESH_initialization_with_no_temps_input_failure()
     MESH_gridify_radar_success()
     MESH_apply_algorithm_success()
     MESH_retrieve_grid_success()
+    MESH_polar_engine_within_tolerance_of_grid_success()
+    MESH_sparse_engine_matches_grid_success()
+    MESH_sparse_engine_detects_shared_azimuths_success()
+    MESH_weights_cache_bounded_by_size_success()
+    MESH_column_products_on_grid_success()
+    MESH_gate_heights_follow_exact_elevations_success()
+
+if KDP_TESTS:
+    print("Beginning Unit Test Subpackage: KDP_TESTS")
+
+    import numpy as np
+    import wradlib as wrl
+
+    def KDP_matches_wradlib_on_precipitation_rays_success():
+        gates = np.arange(400)
+        phidp = np.tile(20 + 30 * np.tanh((gates - 200) / 40.), (360, 1))
+        # Seeded so the noisy profile, and so the comparison, is the same on every run
+        phidp += np.random.default_rng(0).normal(0, 1, phidp.shape)
+
+        expected = wrl.dp.kdp_from_phidp(phidp, winlen=7)
+        kdp = kdp_from_phidp(phidp, winlen=7)
+
+        assert(np.allclose(kdp[:, 7:-7], expected[:, 7:-7], atol=0.05))
+
+        print("Test \'KDP_matches_wradlib_on_precipitation_rays_success\' Passed Assertions")
+
+    def KDP_skips_masked_and_low_rhohv_gates_success():
+        phidp = np.ma.masked_all((10, 100))
+        phidp[:5, :] = np.linspace(0, 50, 100)
+        rhohv = np.ones((10, 100))
+        rhohv[:5, 50:] = 0.5
+
+        kdp = kdp_from_phidp(phidp, rhohv=rhohv, winlen=7)
+
+        assert(kdp[5:].mask.all())
+        assert(kdp[:5, 50:].mask.all())
+        assert(np.allclose(kdp[:5, 10:40], 0.5 * 50 / 99))
+
+        print("Test \'KDP_skips_masked_and_low_rhohv_gates_success\' Passed Assertions")
+
+    KDP_matches_wradlib_on_precipitation_rays_success()
+    KDP_skips_masked_and_low_rhohv_gates_success()
+
+if TRIAGE_TESTS:
+    print("Beginning Unit Test Subpackage: TRIAGE_TESTS")
+
+    import numpy as np
+
+    def _triage_radar(reflectivity, zdr=0.5, rhohv=0.98):
+        radar = pyart.testing.make_empty_ppi_radar(100, 360, 2)
+        shape = (radar.nrays, radar.ngates)
+        for field, value in (('reflectivity', reflectivity), ('differential_reflectivity', zdr),
+                             ('cross_correlation_ratio', rhohv)):
+            radar.add_field(field, {'data': np.ma.masked_array(np.full(shape, value, dtype=np.float32))})
+        return radar
+
+    def TRIAGE_skips_scans_without_hail_success():
+        triage = Triage()
+
+        weak = triage.check(_triage_radar(35.))
+        core = _triage_radar(20.)
+        core.fields['reflectivity']['data'][:2, :2] = 50.
+        small = triage.check(core)
+        storm = _triage_radar(20.)
+        storm.fields['reflectivity']['data'][:20, 10:30] = 55.
+        hail = triage.check(storm)
+
+        assert(weak.reason == 'weak echo')
+        assert(small.reason == 'small core' and small.stats['core_gates'] == 4)
+        assert(hail.reason is None and hail.dual_pol)
+        assert(triage.check(_triage_radar(55., zdr=-9.)).dual_pol is False)
+
+        print("Test \'TRIAGE_skips_scans_without_hail_success\' Passed Assertions")
+
+    def TRIAGE_report_estimates_saved_time_success():
+        report = TriageReport()
+        day = datetime(2020, 5, 1).date()
+        report.processed(day, 0.1, 10.)
+        report.processed(day, 0.1, 20.)
+        report.skipped(day, 'weak echo', 0.1)
+        report.skipped(day, 'weak echo', 0.1)
+
+        summary = report.summary(day)
+
+        assert(summary['skipped'] == 2 and summary['reasons'] == {'weak echo': 2})
+        assert(abs(summary['saved_seconds'] - (2 * 15. - 0.4)) < 1e-9)
+
+        print("Test \'TRIAGE_report_estimates_saved_time_success\' Passed Assertions")
+
+    TRIAGE_skips_scans_without_hail_success()
+    TRIAGE_report_estimates_saved_time_success()
+
+if MOSAIC_TESTS:
+    print("Beginning Unit Test Subpackage: MOSAIC_TESTS")
+
+    import numpy as np
+
+    def MOSAIC_overlapping_stations_keep_maximum_success():
+        mosaic = Mosaic()
+        lons, lats = np.meshgrid(np.linspace(-98, -97, 51), np.linspace(35, 36, 51))
+        when = datetime(2020, 5, 1, 12, 1)
+        mosaic.add('KTLX', np.full(lons.shape, 10.), lons, lats, when)
+        mosaic.add('KINX', np.full(lons.shape, 20.), lons + 0.5, lats, when + timedelta(minutes=2))
+
+        windows = list(mosaic.flush())
+
+        assert(len(windows) == 1)
+        start, stations, (mesh, mesh_lons, mesh_lats) = windows[0]
+        assert(start == datetime(2020, 5, 1, 12, 0))
+        assert(stations == {'KTLX', 'KINX'})
+        assert(mesh.shape == mesh_lons.shape == mesh_lats.shape)
+        assert(mesh.max() == 20)
+        assert(mesh[(mesh_lons > -97.9) & (mesh_lons < -97.6) & (mesh_lats > 35.1) & (mesh_lats < 35.9)].min() == 10)
+        assert(mosaic.windows() == [])
+
+        print("Test \'MOSAIC_overlapping_stations_keep_maximum_success\' Passed Assertions")
+
+    def MOSAIC_flush_only_finished_windows_success():
+        mosaic = Mosaic()
+        lons, lats = np.meshgrid(np.linspace(-98, -97, 11), np.linspace(35, 36, 11))
+        mosaic.add('KTLX', np.ones(lons.shape), lons, lats, datetime(2020, 5, 1, 12, 1))
+        mosaic.add('KTLX', np.ones(lons.shape), lons, lats, datetime(2020, 5, 1, 12, 6))
+
+        windows = list(mosaic.flush(before=datetime(2020, 5, 1, 12, 7)))
+
+        assert([window[0] for window in windows] == [datetime(2020, 5, 1, 12, 0)])
+        assert(mosaic.windows() == [datetime(2020, 5, 1, 12, 5)])
+
+        print("Test \'MOSAIC_flush_only_finished_windows_success\' Passed Assertions")
+
+    def MOSAIC_coarse_station_grid_leaves_no_holes_success():
+        mosaic = Mosaic()
+        # 0.05 deg is 2.5 national cells, binning the points alone leaves holes between them
+        lons, lats = np.meshgrid(np.linspace(-98, -97, 21), np.linspace(35, 36, 21))
+        mosaic.add('KTLX', np.full(lons.shape, 10.), lons, lats, datetime(2020, 5, 1, 12, 1))
+
+        _, _, (mesh, mesh_lons, mesh_lats) = next(mosaic.flush())
+
+        inside = (mesh_lons > -98) & (mesh_lons < -97) & (mesh_lats > 35) & (mesh_lats < 36)
+        assert((mesh[inside] == 10).all())
+        # Nothing spreads further than half a step beyond the field
+        assert(mesh[(mesh_lons < -98.03) | (mesh_lons > -96.97)].max() == 0)
+
+        print("Test \'MOSAIC_coarse_station_grid_leaves_no_holes_success\' Passed Assertions")
+
+    def SWATH_keeps_daily_maximum_and_time_success():
+        import tempfile
+
+        lons, lats = np.meshgrid(np.linspace(-98, -97, 51), np.linspace(35, 36, 51))
+        day = datetime(2020, 5, 1)
+        with tempfile.TemporaryDirectory() as directory:
+            swath = DailySwath(day.date(), directory + '/')
+            swath.update(np.full(lons.shape, 20.), lons, lats, day + timedelta(hours=1))
+            swath.update(np.full(lons.shape, 10.), lons, lats, day + timedelta(hours=2))
+            assert(swath.update(np.full(lons.shape, 30.), lons + 0.5, lats, day + timedelta(hours=3)) > 0)
+
+            # Reopening the day picks up the same memory-mapped swath
+            mesh, mesh_lons, mesh_lats, times = DailySwath(day.date(), directory + '/').swath()
+
+        assert(mesh.shape == mesh_lons.shape == mesh_lats.shape == times.shape)
+        west = (mesh_lons > -97.9) & (mesh_lons < -97.6) & (mesh_lats > 35.1) & (mesh_lats < 35.9)
+        assert((mesh[west] == 20).all() and (times[west] == 3600).all())
+        assert(mesh.max() == 30 and times.max() == 3 * 3600)
+
+        print("Test \'SWATH_keeps_daily_maximum_and_time_success\' Passed Assertions")
+
+    def SWATH_timezone_aware_scan_times_success():
+        import tempfile
+        from datetime import timezone
+
+        lons, lats = np.meshgrid(np.linspace(-98, -97, 51), np.linspace(35, 36, 51))
+        # Scan times carry UTC, as the NEXRAD file listings give them
+        scan = datetime(2020, 5, 1, 2, 30, tzinfo=timezone.utc)
+        with tempfile.TemporaryDirectory() as directory:
+            swath = DailySwath(scan.date(), directory + '/')
+            assert(swath.update(np.full(lons.shape, 20.), lons, lats, scan) > 0)
+            # The same instant given in another timezone lands on the same time of max
+            eastern = timezone(timedelta(hours=-4))
+            swath.update(np.full(lons.shape, 25.), lons, lats, scan.astimezone(eastern) + timedelta(hours=1))
+            _, _, _, times = swath.swath()
+
+        assert(times.max() == 3.5 * 3600)
+
+        print("Test \'SWATH_timezone_aware_scan_times_success\' Passed Assertions")
+
+    def SWATH_gate_spacing_near_grid_resolution_leaves_no_holes_success():
+        import tempfile
+
+        day = datetime(2020, 5, 1)
+        with tempfile.TemporaryDirectory() as directory:
+            swath = DailySwath(day.date(), directory + '/')
+            for step in (0.0195, 0.02, 0.0205):
+                lons, lats = np.meshgrid(-98 + step * np.arange(50), 35 + step * np.arange(50))
+                swath.update(np.full(lons.shape, 20.), lons, lats, day + timedelta(hours=1))
+                mesh, mesh_lons, mesh_lats, times = swath.swath()
+
+                inside = (mesh_lons > lons.min()) & (mesh_lons < lons.max()) & \
+                         (mesh_lats > lats.min()) & (mesh_lats < lats.max())
+                assert((mesh[inside] == 20).all() and (times[inside] == 3600).all())
+
+        print("Test \'SWATH_gate_spacing_near_grid_resolution_leaves_no_holes_success\' Passed Assertions")
+
+    MOSAIC_overlapping_stations_keep_maximum_success()
+    MOSAIC_flush_only_finished_windows_success()
+    MOSAIC_coarse_station_grid_leaves_no_holes_success()
+    SWATH_keeps_daily_maximum_and_time_success()
+    SWATH_timezone_aware_scan_times_success()
+    SWATH_gate_spacing_near_grid_resolution_leaves_no_holes_success()
+
+if CONTOUR_TESTS:
+    print("Beginning Unit Test Subpackage: CONTOUR_TESTS")
+
+    import numpy as np
+
+    lons, lats = np.meshgrid(np.linspace(-98, -97, 101), np.linspace(35, 36, 101))
+    hill = 50 * np.exp(-((lons + 97.5) ** 2 + (lats - 35.5) ** 2) / 0.02)
+
+    def CONTOUR_filled_bands_nest_success():
+        levels = [10, 20, 30, 40]
+
+        bands = filled_contours(lons, lats, hill, levels)
+
+        assert([band[:2] for band in bands] == [(10, 20), (20, 30), (30, 40)])
+        for _, _, rings in bands:
+            assert(len(rings) == len(bands[0][2]))
+            for ring in rings:
+                assert(ring.shape[1] == 2 and (ring[0] == ring[-1]).all())
+        # Every band is a ring around the peak, narrowing with height
+        widths = [np.ptp(np.concatenate(rings)[:, 0]) for _, _, rings in bands]
+        assert(widths == sorted(widths, reverse=True))
+        assert(len(level_colors(levels)) == 3)
+
+        print("Test \'CONTOUR_filled_bands_nest_success\' Passed Assertions")
+
+    def CONTOUR_level_colors_by_name_or_colormap_success():
+        from matplotlib import cm
+
+        levels = [10, 20, 30, 40]
+
+        colors = level_colors(levels, 'viridis')
+
+        assert(level_colors(levels) == colors)
+        assert(level_colors(levels, cm.viridis) == colors)
+        assert(colors[0] != colors[-1] and all(color.startswith('#') for color in colors))
+
+        print("Test \'CONTOUR_level_colors_by_name_or_colormap_success\' Passed Assertions")
+
+    def CONTOUR_concurrent_products_success():
+        from concurrent.futures import ThreadPoolExecutor
+
+        levels = np.linspace(0, 50, 6)
+        expected = filled_contours(lons, lats, hill, levels)
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(lambda _: filled_contours(lons, lats, hill, levels), range(8)))
+
+        for bands in results:
+            for (_, _, rings), (_, _, expected_rings) in zip(bands, expected):
+                assert(all(np.array_equal(a, b) for a, b in zip(rings, expected_rings)))
+
+        print("Test \'CONTOUR_concurrent_products_success\' Passed Assertions")
+
+    def CONTOUR_index_space_matches_coordinates_success():
+        # Curvilinear polar coordinates, as for a sweep
+        azimuths, ranges = np.meshgrid(np.radians(np.arange(0, 360, 2.)), np.linspace(1, 100, 100), indexing='ij')
+        x, y = ranges * np.sin(azimuths), ranges * np.cos(azimuths)
+        field = 50 * np.exp(-((x - 40) ** 2 + (y - 10) ** 2) / 200)
+        levels = [10, 20, 30, 40]
+
+        expected = filled_contours(x, y, field, levels)
+        bands = filled_contours(x, y, field, levels, index_space=True)
+
+        for (_, _, rings), (_, _, expected_rings) in zip(bands, expected):
+            assert(len(rings) == len(expected_rings))
+            for ring, expected_ring in zip(rings, expected_rings):
+                assert(ring.shape == expected_ring.shape)
+                assert(np.allclose(ring, expected_ring, atol=1e-6))
+
+        print("Test \'CONTOUR_index_space_matches_coordinates_success\' Passed Assertions")
+
+    def CONTOUR_converter_builds_feature_documents_success():
+        converter = GeoJSONConverter(hill, lons, lats, 'MESH', 'KTLX', datetime(2020, 5, 1, 12),
+                                     levels=[10, 20, 30, 40])
+
+        features = converter.get_features()
+        stats = converter.get_build_stats()
+
+        assert(len(features) == stats['features'] > 0)
+        assert(stats['vertices'] >= 4 * len(features))
+        for feature in features:
+            assert(feature['type'] == 'Feature' and feature['geometry']['type'] == 'Polygon')
+            assert(feature['properties']['id'] == converter.get_id())
+            assert(feature['properties']['value'] in (10, 20, 30))
+            assert(feature['station'] == 'KTLX')
+            assert(feature['geometry']['coordinates'][0] == feature['geometry']['coordinates'][-1])
+
+        print("Test \'CONTOUR_converter_builds_feature_documents_success\' Passed Assertions")
+
+    def CONTOUR_simplified_quantized_features_shrink_success():
+        converter = GeoJSONConverter(hill, lons, lats, 'MESH', 'KTLX', datetime(2020, 5, 1, 12),
+                                     levels=[10, 20, 30, 40], simplify=500, quantize=True)
+
+        stats = converter.get_build_stats()
+        full = GeoJSONConverter(hill, lons, lats, 'MESH', 'KTLX', datetime(2020, 5, 1, 12),
+                                levels=[10, 20, 30, 40]).get_features()
+
+        assert(stats['vertices'] < stats['vertices_in'])
+        assert(stats['bytes'] < stats['bytes_in'])
+        for feature, expected in zip(converter.get_features(), full):
+            ring = decode_ring(feature['geometry']['coordinates'], feature['geometry']['digits'])
+            expected = np.asarray(expected['geometry']['coordinates'])
+            # Simplified vertices stay within the tolerance of the full ring's extent
+            assert((np.abs(ring.min(axis=0) - expected.min(axis=0)) < 0.01).all())
+            assert((np.abs(ring.max(axis=0) - expected.max(axis=0)) < 0.01).all())
+
+        print("Test \'CONTOUR_simplified_quantized_features_shrink_success\' Passed Assertions")
+
+    def CONTOUR_simplified_bands_share_edges_success():
+        bands = filled_contours(lons, lats, hill, [10, 20, 30, 40])
+
+        simplified = simplify_coverage([rings for _, _, rings in bands], 500)
+
+        assert(sum(len(ring) for rings in simplified for ring in rings) <
+               sum(len(ring) for _, _, rings in bands for ring in rings))
+        # The hole of each band is still exactly the shell of the band above
+        for lower, upper in zip(simplified[:-1], simplified[1:]):
+            hole = min(lower, key=lambda ring: np.ptp(ring[:, 0]))
+            shell = max(upper, key=lambda ring: np.ptp(ring[:, 0]))
+            assert(set(map(tuple, hole)) == set(map(tuple, shell)))
+
+        print("Test \'CONTOUR_simplified_bands_share_edges_success\' Passed Assertions")
+
+    def CONTOUR_cropped_windows_match_whole_field_success():
+        from scipy.ndimage import gaussian_filter
+
+        # Two storms far apart on a larger field, one of them partly masked
+        wide_lons, wide_lats = np.meshgrid(np.linspace(-99, -96, 301), np.linspace(34, 37, 301))
+        storms = 50 * np.exp(-((wide_lons + 98.5) ** 2 + (wide_lats - 34.5) ** 2) / 0.02) + \
+            40 * np.exp(-((wide_lons + 96.5) ** 2 + (wide_lats - 36.5) ** 2) / 0.005)
+        field = np.ma.masked_where((abs(wide_lons + 96.4) < 0.05) & (abs(wide_lats - 36.5) < 0.05), storms)
+        levels = [5, 15, 25, 35, 45]
+
+        converter = GeoJSONConverter(field, wide_lons, wide_lats, 'HDR', 'KTLX', datetime(2020, 5, 1, 12),
+                                     levels=levels)
+        features = converter.get_features()
+        stats = converter.get_build_stats()
+        expected = filled_contours(wide_lons, wide_lats, gaussian_filter(np.ma.filled(field, 9999), sigma=2), levels)
+
+        def _area(ring):
+            ring = np.asarray(ring)
+            return abs(np.dot(ring[:-1, 0], ring[1:, 1]) - np.dot(ring[1:, 0], ring[:-1, 1])) / 2
+
+        # Only the areas around the storms are smoothed and contoured
+        assert(stats['windows'] == 2)
+        assert(stats['smoothed_points'] < 0.25 * field.size)
+        for lower, _, expected_rings in expected:
+            areas = sorted(_area(feature['geometry']['coordinates']) for feature in features
+                           if feature['properties']['value'] == lower)
+            assert(np.allclose(areas, sorted(_area(ring) for ring in expected_rings), rtol=0.01, atol=1e-4))
+
+        print("Test \'CONTOUR_cropped_windows_match_whole_field_success\' Passed Assertions")
+
+    def CONTOUR_streamed_batches_match_features_success():
+        levels = [10, 20, 30, 40]
+        expected = GeoJSONConverter(hill, lons, lats, 'MESH', 'KTLX', datetime(2020, 5, 1, 12),
+                                    levels=levels).get_features()
+        converter = GeoJSONConverter(hill, lons, lats, 'MESH', 'KTLX', datetime(2020, 5, 1, 12),
+                                     levels=levels, stream=True)
+
+        assert(converter.get_features() == [] and converter.get_relational_id() is None)
+        batches = list(converter.iter_batches(5))
+
+        assert(all(len(batch) == 5 for batch in batches[:-1]) and 0 < len(batches[-1]) <= 5)
+        assert([feature for batch in batches for feature in batch] == expected)
+        assert(converter.get_relational_id()['featurecount'] == len(expected))
+        assert(converter.get_build_stats()['features'] == len(expected))
+        assert(list(converter.iter_features()) == [])
+
+        print("Test \'CONTOUR_streamed_batches_match_features_success\' Passed Assertions")
+
+    def CONTOUR_streamed_failure_reaches_consumer_success():
+        converter = GeoJSONConverter(hill, lons, lats, 'MESH', 'KTLX', datetime(2020, 5, 1, 12),
+                                     levels=[10, 20, 30, 40], stream=True)
+        levels = converter._contours
+
+        def _failing_levels():
+            yield next(levels)
+            raise ValueError("contouring failed")
+
+        converter._contours = _failing_levels()
+        features = converter.iter_features()
+        next(features)
+        with pytest.raises(ValueError):
+            list(features)
+        # A partial product is never given a relational id
+        assert(converter.get_relational_id() is None)
+
+        print("Test \'CONTOUR_streamed_failure_reaches_consumer_success\' Passed Assertions")
+
+    CONTOUR_filled_bands_nest_success()
+    CONTOUR_level_colors_by_name_or_colormap_success()
+    CONTOUR_concurrent_products_success()
+    CONTOUR_index_space_matches_coordinates_success()
+    CONTOUR_converter_builds_feature_documents_success()
+    CONTOUR_simplified_quantized_features_shrink_success()
+    CONTOUR_simplified_bands_share_edges_success()
+    CONTOUR_cropped_windows_match_whole_field_success()
+    CONTOUR_streamed_batches_match_features_success()
+    CONTOUR_streamed_failure_reaches_consumer_success()
+
+
+if TILES_TESTS:
+    print("Beginning Unit Test Subpackage: TILES_TESTS")
+
+    import gzip
+    import os
+    import tempfile
+
+    import numpy as np
+
+    lons, lats = np.meshgrid(np.linspace(-98, -97, 101), np.linspace(35, 36, 101))
+    hill = 50 * np.exp(-((lons + 97.5) ** 2 + (lats - 35.5) ** 2) / 0.02)
+
+    def _mesh_features(station, offset=0.):
+        # MESH vertices are (lon, lat)
+        return GeoJSONConverter(hill, lons + offset, lats, 'MESH', station, datetime(2020, 5, 1, 12),
+                                levels=[10, 20, 30, 40]).get_features()
+
+    def TILES_features_cut_in_to_zoom_pyramid_success():
+        with tempfile.TemporaryDirectory() as directory:
+            cache = TileCache(os.path.join(directory, 'hail.mbtiles'), min_zoom=3, max_zoom=8)
+
+            written = cache.update('MESH', 'KTLX', _mesh_features('KTLX'))
+
+            # -97.5, 35.5 lies in tile x=7, y=12 at zoom 5
+            tile = cache.tile(5, 7, 12)
+            assert(tile is not None and b'MESH' in gzip.decompress(tile))
+            zooms = [row[0] for row in cache._db.execute('SELECT DISTINCT zoom_level FROM tiles')]
+            assert(sorted(zooms) == list(range(3, 9)))
+            assert(written == cache._db.execute('SELECT COUNT(*) FROM tiles').fetchone()[0])
+            cache.close()
+
+        print("Test \'TILES_features_cut_in_to_zoom_pyramid_success\' Passed Assertions")
+
+    def TILES_incremental_update_only_touches_station_success():
+        with tempfile.TemporaryDirectory() as directory:
+            cache = TileCache(os.path.join(directory, 'hail.mbtiles'), min_zoom=3, max_zoom=6)
+            cache.update('MESH', 'KTLX', _mesh_features('KTLX'))
+            before = cache.tile(5, 7, 12)
+
+            # A station far to the east shares none of KTLX's tiles
+            written = cache.update('MESH', 'KOKX', _mesh_features('KOKX', offset=24.))
+            assert(cache.tile(5, 7, 12) == before)
+            assert(written < cache._db.execute('SELECT COUNT(*) FROM tiles').fetchone()[0])
+
+            # A scan without hail clears the station's tiles only
+            cache.update('MESH', 'KTLX', [])
+            assert(cache.tile(5, 7, 12) is None)
+            assert(cache._db.execute('SELECT COUNT(*) FROM tiles WHERE zoom_level=5').fetchone()[0] > 0)
+            cache.close()
+
+        print("Test \'TILES_incremental_update_only_touches_station_success\' Passed Assertions")
+
+    TILES_features_cut_in_to_zoom_pyramid_success()
+    TILES_incremental_update_only_touches_station_success()
+
+
+if COLUMNAR_TESTS:
+    print("Beginning Unit Test Subpackage: COLUMNAR_TESTS")
+
+    import os
+    import tempfile
+
+    import numpy as np
+
+    lons, lats = np.meshgrid(np.linspace(-98, -97, 101), np.linspace(35, 36, 101))
+    hill = 50 * np.exp(-((lons + 97.5) ** 2 + (lats - 35.5) ** 2) / 0.02)
+
+    def COLUMNAR_round_trip_matches_features_success():
+        from datetime import timezone
+
+        # Scan times carry UTC, naive times are taken as UTC
+        when = datetime(2020, 5, 1, 12, tzinfo=timezone.utc)
+        # HDR vertices are (lat, lon), MESH (lon, lat)
+        hdr = GeoJSONConverter(hill, lats, lons, 'HDR', 'KTLX', when, levels=[10, 20, 30, 40]).get_features()
+        mesh = GeoJSONConverter(hill, lons, lats, 'MESH', 'KTLX', datetime(2020, 5, 1, 12), levels=[10, 20, 30, 40],
+                                quantize=True).get_features()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, '12.htc')
+            write_features(path, hdr, 'HDR')
+            write_features(path, mesh, 'MESH')
+            columns = read_columns(path)
+
+        assert(len(columns['geometry']) == len(columns['value']) == len(hdr) + len(mesh))
+        assert(set(columns['algorithm']) == {'HDR', 'MESH'})
+        # WKB is always (lon, lat)
+        first = np.asarray(hdr[0]['geometry']['coordinates'])
+        assert(np.allclose(ring_from_wkb(columns['geometry'][0]), first[:, ::-1]))
+        assert((ring_from_wkb(columns['geometry'][-1])[:, 0] < -96).all())
+
+        features = to_features(columns)
+        for feature, expected in zip(features, hdr):
+            assert(feature['geometry']['coordinates'] == expected['geometry']['coordinates'])
+            assert(feature['properties']['value'] == expected['properties']['value'])
+            assert(feature['properties']['color'] == expected['properties']['color'])
+            assert(feature['station'] == 'KTLX')
+        assert(all(feature['collectiontime'] == when for feature in features))
+
+        print("Test \'COLUMNAR_round_trip_matches_features_success\' Passed Assertions")
+
+    COLUMNAR_round_trip_matches_features_success()
+
+
+if DELTA_TESTS:
+    print("Beginning Unit Test Subpackage: DELTA_TESTS")
+
+    import numpy as np
+
+    lons, lats = np.meshgrid(np.linspace(-98, -97, 101), np.linspace(35, 36, 101))
+    hill = 50 * np.exp(-((lons + 97.5) ** 2 + (lats - 35.5) ** 2) / 0.02)
+
+    def DELTA_unchanged_levels_become_references_success():
+        encoder = DeltaEncoder()
+        scans = []
+        # The peak grows on the last scan, changing only the upper levels
+        for minute, field in ((0, hill), (5, hill), (10, np.where(hill > 48, 60., hill))):
+            converter = GeoJSONConverter(field, lons, lats, 'MESH', 'KTLX', datetime(2020, 5, 1, 12, minute),
+                                         levels=[10, 20, 30, 40])
+            scans.append((converter.get_features(), converter.get_metadata(), converter.get_relational_id()))
+
+        changed, references = encoder.encode(*scans[0])
+        assert(changed == scans[0][0] and references == [])
+
+        changed, references = encoder.encode(*scans[1])
+        assert(changed == [] and {reference['value'] for reference in references} == {10, 20, 30})
+        assert(all(reference['ref'] == scans[0][2]['id'] for reference in references))
+        assert(sum(reference['featurecount'] for reference in references) == len(scans[1][0]))
+
+        changed, references = encoder.encode(*scans[2])
+        values = {reference['value'] for reference in references}
+        assert(10 in values and 30 not in values)
+        # Still pointing at the scan the features were inserted with
+        assert(all(reference['ref'] == scans[0][2]['id'] for reference in references))
+        assert({feature['properties']['value'] for feature in changed} == {10, 20, 30} - values)
+
+        print("Test \'DELTA_unchanged_levels_become_references_success\' Passed Assertions")
+
+    DELTA_unchanged_levels_become_references_success()
+
+
+if DB_TESTS:
+    print("Beginning Unit Test Subpackage: DB_TESTS")
+
+    import os
+
+    def DB_client_shared_per_process_success():
+        from concurrent.futures import ThreadPoolExecutor
+
+        client = db.get_connection()
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            assert(all(conn is client for conn in pool.map(lambda _: db.get_connection(), range(8))))
+        # A client made before a fork is not handed to the child
+        db._clients = {-1: client}
+        assert(db.get_connection() is not client and list(db._clients) == [os.getpid()])
+        db.close_connection()
+        assert(db.get_connection() is not client)
+
+        print("Test \'DB_client_shared_per_process_success\' Passed Assertions")
+
+    DB_client_shared_per_process_success()
+
+
+if SRTM_TESTS:
+    print("Beginning Unit Test Subpackage: SRTM_TESTS")
+
+    def SRTM_station_outside_raster_not_rebuilt_success():
+        import tempfile
+
+        saved = srtm_tiles.TILE_DIR, srtm_tiles.INDEX_FILE, srtm_tiles.SRTM_ZIP
+        with tempfile.TemporaryDirectory() as directory:
+            srtm_tiles.TILE_DIR = directory + '/'
+            srtm_tiles.INDEX_FILE = directory + '/index.json'
+            srtm_tiles.SRTM_ZIP = directory + '/archive.zip'
+            open(srtm_tiles.SRTM_ZIP, 'w').close()
+            srtm_tiles._index = None
+            try:
+                srtm_tiles._add_to_index('PGUA', {'file': None, 'reason': 'outside of the SRTM raster'})
+
+                assert(srtm_tiles.unavailable('PGUA') and not srtm_tiles.unavailable('KTLX'))
+                assert(srtm_tiles.tile_path('PGUA') is None)
+                # No background build is started, so the archive is never opened for it
+                assert(srtm_tiles.build_in_background(['PGUA']) is None)
+                assert(srtm('PGUA') == 'UNDEF')
+            finally:
+                srtm_tiles.TILE_DIR, srtm_tiles.INDEX_FILE, srtm_tiles.SRTM_ZIP = saved
+                srtm_tiles._index = None
+
+        print("Test \'SRTM_station_outside_raster_not_rebuilt_success\' Passed Assertions")
+
+    SRTM_station_outside_raster_not_rebuilt_success()
 
 if HAIL_SIZE_DISCRIMINATION_ALGORITHM_TESTS:
     print("Beginning Unit Test Subpackage: HAIL_SIZE_DISCRIMINATION_ALGORITHM_TESTS")